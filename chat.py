@@ -1,10 +1,34 @@
 #!/usr/bin/jython
-from javax.swing import SwingConstants, ScrollPaneConstants, JFrame ,JPanel, JLabel, JButton, JTextPane, JTextArea, JTextField , JOptionPane, BorderFactory , GroupLayout , JScrollPane, KeyStroke
+from javax.swing import SwingUtilities, SwingConstants, ScrollPaneConstants, JFrame ,JPanel, JLabel, JButton, JList, JTextArea, JTextField , JPasswordField, JOptionPane, BorderFactory , GroupLayout , JScrollPane, KeyStroke, AbstractListModel, ListCellRenderer
 from java.awt import Dimension, Color, Font, AWTKeyStroke
 from java.awt.event import KeyEvent, KeyAdapter
-from javax.swing.text import SimpleAttributeSet
-from threading import Thread
-import telnetlib
+from threading import Thread, Lock
+import random
+import select
+import socket
+import time
+import chat_frames
+
+#  Seconds to wait for the server to accept the connection, and for the whole registration once connected
+CONNECT_TIMEOUT = 10
+REGISTER_TIMEOUT = 15
+#  How long the receive loop waits in select before checking the connection again, and how much it reads at once
+POLL_TIMEOUT = 1.0
+RECV_SIZE = 65536
+#  First and longest wait between attempts to reconnect after the connection drops
+RECONNECT_DELAY = 1.0
+RECONNECT_MAX_DELAY = 30.0
+#  Seconds without a byte from the server after which the client pings it, and after which the connection is taken to
+#  be dead. The client pings for itself because its own messages are not echoed back, so a client talking in a quiet
+#  room is never pinged by the server
+KEEPALIVE_INTERVAL = 60.0
+SILENCE_TIMEOUT = 180.0
+#  Why a login attempt failed, as shown to the user
+BAD_NAME = 'Bad Username, please choose another'
+BAD_LOGIN = 'Wrong Username or Password'
+NO_SERVER = 'Connection Error, No Server Available!'
+#  Number of messages kept in the message list, the oldest are dropped beyond this
+SCROLLBACK = 1000
 
 ###  ChatApp class to build the login GUI and set up the connection (inherits from JFrame)
 
@@ -42,32 +66,39 @@ class ChatApp(JFrame):
 		self.getContentPane().setLayout(layout)	
 		layout.setAutoCreateGaps(True)
 		layout.setAutoCreateContainerGaps(True)
-		self.setPreferredSize(Dimension(300, 150))
+		self.setPreferredSize(Dimension(300, 190))
 		#  Create the labels
 		user_label= JLabel(" Username : ",JLabel.LEFT, font=self.label_font) 
+		password_label=JLabel(" Password : ", JLabel.LEFT, font=self.label_font)
 		server_label=JLabel("  Server  : ", JLabel.LEFT, font=self.label_font)
 				
 		#  Colours
 		user_label.setForeground(foreground_colour)
+		password_label.setForeground(foreground_colour)
 		server_label.setForeground(foreground_colour)
 		
 		#  Create the text entries
 		self.username=JTextField(actionPerformed=self.continueEvent, border=self.border2,  font = self.entry_font)
+		#  Only needed for servers that check passwords
+		self.password=JPasswordField(actionPerformed=self.continueEvent, border=self.border2,  font = self.entry_font)
 		self.server=JTextField(actionPerformed=self.continueEvent, border=self.border2,  font = self.entry_font)
 		
 		#  Colours
 		self.username.setBackground(background_colour)
+		self.password.setBackground(background_colour)
 		self.server.setBackground(background_colour)
 		self.username.setForeground(foreground_colour)
+		self.password.setForeground(foreground_colour)
 		self.server.setForeground(foreground_colour)
 		
 		#  Allow editable
 		self.username.setEditable(True)
+		self.password.setEditable(True)
 		self.server.setEditable(True)
 		
 		#  Create the buttons
 		quit_btn=JButton("  Quit!  ", actionPerformed=self.closeEvent, border=self.border2, font=self.btn_font)
-		go_btn=JButton("   Go!   ", actionPerformed=self.continueEvent, border=self.border2, font=self.btn_font)
+		self.go_btn=go_btn=JButton("   Go!   ", actionPerformed=self.continueEvent, border=self.border2, font=self.btn_font)
 		#  Colours
 		quit_btn.setBackground(background_colour)
 		go_btn.setBackground(background_colour)
@@ -80,11 +111,13 @@ class ChatApp(JFrame):
 			#  Left side
 			.addGroup(layout.createParallelGroup(GroupLayout.Alignment.TRAILING)
 				.addComponent(user_label)
+				.addComponent(password_label)
 				.addComponent(server_label))
 				
 			#  Right side
 			.addGroup(layout.createParallelGroup(GroupLayout.Alignment.CENTER)
 				.addComponent(self.username)
+				.addComponent(self.password)
 				.addComponent(self.server)
 				.addGroup(layout.createSequentialGroup()
 					.addComponent(quit_btn)
@@ -97,6 +130,9 @@ class ChatApp(JFrame):
 			.addGroup(layout.createParallelGroup(GroupLayout.Alignment.CENTER)
 				.addComponent(user_label)
 				.addComponent(self.username))
+			.addGroup(layout.createParallelGroup(GroupLayout.Alignment.CENTER)
+				.addComponent(password_label)
+				.addComponent(self.password))
 			#  Middle group
 			.addGroup(layout.createParallelGroup(GroupLayout.Alignment.CENTER)
 				.addComponent(server_label)
@@ -128,44 +164,66 @@ class ChatApp(JFrame):
 	##  Event driven function to respond to send button click, grabs text and sends it down the wire	
 	
 	def continueEvent(self,event):
-		'''Function that retreives the login details for sending to the server
+		'''Function that retreives the login details and starts connecting to the server
 		'''	
+		#  Already connecting, ignore repeated clicks and return presses
+		if not self.go_btn.isEnabled():
+			return
 		#  Grab the text that has been entered
 		user = self.username.getText()
+		password = ''.join(self.password.getPassword())
 		Host = self.server.getText()
 		#  Default port
 		Port=60001
-		connected=False
-		while not connected:
-		#  Try make a connection except when there isn't one available, then quit program'
-			try:
-				tn=telnetlib.Telnet(Host, Port)
-				connected=True
-				continue
-			except:
-				JOptionPane.showMessageDialog(self,'Connection Error, No Server Available!')
-				self.username.setText('')
-				self.server.setText('')
-				self.username.requestFocusInWindow()
-				return
-		#  Listen for a response	
-		response = tn.read_until('<<<')
-		print(response)
-		#  Acknowledge with the username
-		tn.write(user+'\r\n')
-		#  Receive validation of name, present dialog if not valid
-		valid_name = tn.read_until('<')
-		valid_name.strip()
-		v_name, delim = valid_name.split('<')
-		if v_name.strip() != 'OK':
-			JOptionPane.showMessageDialog(self,'Bad Username, please choose another')
+		#  Connecting can take a while on a slow link, so it happens on its own thread and the window stays responsive
+		self.setLoginEnabled(False)
+		t=Thread(target=self.connectFunction, args=(user, password, Host, Port))
+		t.daemon=True
+		t.start()
+	
+	##  Function to enable or disable the login fields while a connection attempt is under way
+	
+	def setLoginEnabled(self, enabled):
+		self.go_btn.setEnabled(enabled)
+		self.username.setEnabled(enabled)
+		self.password.setEnabled(enabled)
+		self.server.setEnabled(enabled)
+	
+	##  Threaded function to connect and register, the outcome is handed back to the event thread
+	
+	def connectFunction(self, user, password, Host, Port):
+		'''Function to make the connection and register the name, off the event thread
+		'''
+		try:
+			result=register(Host, Port, user, password)
+		#  The error carries the reason to show the user
+		except RegistrationError as error:
+			result=str(error)
+		#  Except when there isn't a server available, or it does not answer in time
+		except (socket.error, EOFError, chat_frames.FrameError):
+			result=NO_SERVER
+		SwingUtilities.invokeLater(lambda: self.connectFinished(user, password, Host, Port, result))
+	
+	##  Function to act on the outcome of a connection attempt, on the event thread
+	
+	def connectFinished(self, user, password, Host, Port, result):
+		'''Opens the chat window once registered, otherwise presents a dialog saying what went wrong
+		'''
+		self.setLoginEnabled(True)
+		if result in (BAD_NAME, BAD_LOGIN, NO_SERVER):
+			JOptionPane.showMessageDialog(self, result)
 			self.username.setText('')
+			self.password.setText('')
+			if result == NO_SERVER:
+				self.server.setText('')
 			self.username.requestFocusInWindow()
 			return
+		sock, decoder, response = result
+		print(response)
 		#  Set the login GUI to hidden
 		self.setVisible(False)  ##   <<<<<<  I have no idea why this doesn't work but I suspect it's something to do with either inheritance or having 2 class instances
-		#  Call the main program, pass the connection as a parameter
-		ChatClient(user,response , tn)
+		#  Call the main program, pass the connection and its decoder as parameters
+		ChatClient(user, password, response, sock, decoder, Host, Port)
 
 ###  Main ChatClient class, inherits from JFrame
 
@@ -173,16 +231,29 @@ class ChatClient(JFrame):
 	
 	##  Constructor method, receives the variables from the ChatApp class as parameters
 	
-	def __init__(self, name, greeting, tn):
+	def __init__(self, name, password, greeting, sock, decoder, host, port, scrollback=SCROLLBACK):
 		'''Constructor, initialises base class & assigns variables
 		'''
 		# Call to the super method to take care of the base class(es)
 		super(ChatClient, self).__init__()
 		#  Assign the relevent variable names
 		self.username=name
+		#  Kept to log in again after a reconnect
+		self.password=password
 		self.greeting=greeting
-		self.tn = tn
-		self.no_users=[]
+		self.sock = sock
+		self.decoder = decoder
+		self.host = host
+		self.port = port
+		#  Names of everyone online, kept by the server's roster and presence frames
+		self.online=set()
+		self.scrollback=scrollback
+		#  Frames received but not yet shown, handed to the event thread in batches
+		self.inbox=[]
+		self.inbox_lock=Lock()
+		#  Both the event thread and the receive thread write to the socket
+		self.send_lock=Lock()
+		self.update_pending=False
 		#  Initiate the Threaded function for receiving messages
 		t1=Thread(target=self.recvFunction)
 		#  Set to daemon 
@@ -217,11 +288,11 @@ class ChatClient(JFrame):
 		self.setPreferredSize(Dimension(400, 450))
 		
 		#  Create widgets and assemble the GUI
-		#  Main display area
-		self.main_content=JTextPane()
+		#  Main display area, a list backed by a model so only the rows on screen are ever rendered
+		self.model=MessageListModel()
+		self.main_content=JList(self.model, componentResized=self.relayoutMessages)
+		self.main_content.setCellRenderer(MessageRenderer(self.label_2_font))
 		self.main_content.setBackground(background_colour)
-		#self.main_content.setForeground(foreground_colour)
-		self.main_content.setEditable(False)
 		#  Message entry area  		
 		self.message=JTextArea( 2,2, border=self.border2, font=self.label_font, keyPressed=self.returnKeyPress)
 		self.message.requestFocusInWindow()	
@@ -249,8 +320,8 @@ class ChatClient(JFrame):
 		self.scroll_message.setPreferredSize(Dimension(150,20))
 		self.scroll_message.setVerticalScrollBarPolicy(ScrollPaneConstants.VERTICAL_SCROLLBAR_ALWAYS)
 		
-		# Test user label, still not updating after first round of messages
-		self.user_label=JLabel(" Users online : %s "%(str(len(self.no_users))),JLabel.RIGHT, font=self.label_2_font)
+		#  Number of users label, its text is updated in place as presence frames arrive
+		self.user_label=JLabel(" Users online : %d "%len(self.online),JLabel.RIGHT, font=self.label_2_font)
 		
 		#  Assemble the components
 		#  Horizontal layout
@@ -294,22 +365,115 @@ class ChatClient(JFrame):
 	def recvFunction(self):
 		'''A function to control the receiving of data from the connection
 		'''
-		#  While the connection is available
-		while self.tn:
-			#  Try to receive data using "<<<" as the delimiter
+		heard = time.time()
+		pinged = False
+		#  Registration reads ahead, so the roster and room history may already be in the decoder. Decode those before
+		#  waiting on the socket, here and after every reconnect
+		data = ''
+		while True:
+			#  Wait until the connection has data, then read everything that is there and decode every complete frame
 			try:
-				message = self.tn.read_until('<<<')
-				#  If a message is received
-				if message:
-					garb, message=message.split('>>>')
-					message, garb = message.split('<<<')
-					message = ('\n'+message+'\n')
-					#  Call the append text function
-					self.appendText(message)
-			#  Except if there is no data available		
-			except:
-				#print('No message')	
-				pass
+				if data is None:
+					readable, writable, errors = select.select([self.sock], [], [], POLL_TIMEOUT)
+					if not readable:
+						#  Ping the server once it has gone quiet, this long without even the answer means the connection is gone
+						quiet = time.time() - heard
+						if quiet > SILENCE_TIMEOUT:
+							raise EOFError('Nothing heard from the server')
+						if quiet > KEEPALIVE_INTERVAL and not pinged:
+							self.send(chat_frames.encode(chat_frames.PING))
+							pinged = True
+						continue
+					data = self.sock.recv(RECV_SIZE)
+					#  An empty read means the server has closed the connection
+					if not data:
+						raise EOFError('Connection closed by the server')
+					heard = time.time()
+					pinged = False
+				frames = self.decoder.frames(data)
+				data = None
+				#  Answer pings straight away from this thread, neither they nor the answers to ours reach the event thread
+				if any(kind in (chat_frames.PING, chat_frames.PONG) for kind, payload in frames):
+					if any(kind == chat_frames.PING for kind, payload in frames):
+						self.send(chat_frames.encode(chat_frames.PONG))
+					frames = [frame for frame in frames if frame[0] not in (chat_frames.PING, chat_frames.PONG)]
+			#  Except if the connection has gone, then get a new one
+			except (EOFError, socket.error, select.error, chat_frames.FrameError):
+				self.reconnect()
+				heard = time.time()
+				pinged = False
+				data = ''
+				continue
+			if frames:
+				self.queueFrames(frames)
+	
+	##  Function to write a frame to the server
+	
+	def send(self, frame):
+		'''Sends the whole frame, one thread at a time so frames from the two threads never interleave
+		'''
+		with self.send_lock:
+			self.sock.sendall(frame)
+	
+	##  Function to hand received frames to the event thread
+	
+	def queueFrames(self, frames):
+		'''Adds the frames to the inbox, asking the event thread for an update only if one is not already on its way
+		'''
+		with self.inbox_lock:
+			self.inbox.extend(frames)
+			if self.update_pending:
+				return
+			self.update_pending=True
+		SwingUtilities.invokeLater(self.showFrames)
+	
+	##  Function run on the event thread to show everything in the inbox
+	
+	def showFrames(self):
+		'''Takes the whole inbox in one go, so a burst of messages costs one event thread update
+		'''
+		with self.inbox_lock:
+			frames, self.inbox = self.inbox, []
+			self.update_pending=False
+		messages = []
+		count = len(self.online)
+		for kind, payload in frames:
+			#  Presence frames only change the set of users online, they are not shown
+			if kind in (chat_frames.OK, chat_frames.ROSTER, chat_frames.ONLINE, chat_frames.OFFLINE):
+				self.updatePresence(kind, payload)
+				continue
+			message = formatFrame(kind, payload)
+			#  If it is a message to display
+			if message is not None:
+				messages.append(('\n'+message.decode('utf-8', 'replace')+'\n', None))
+		#  Call the append messages function once for the whole batch
+		if messages:
+			self.appendMessages(messages)
+		if len(self.online) != count:
+			self.user_label.setText(" Users online : %d "%len(self.online))
+	
+	##  Function to get a new connection after the old one drops
+	
+	def reconnect(self):
+		'''Closes the dead connection and tries again with a growing, randomised delay until registered
+		'''
+		try:
+			self.sock.close()
+		except socket.error:
+			pass
+		delay = RECONNECT_DELAY
+		while True:
+			self.queueFrames([(chat_frames.NOTICE, 'Connection lost, reconnecting in %d seconds'%delay)])
+			time.sleep(delay * random.uniform(0.5, 1.0))
+			try:
+				self.sock, self.decoder, greeting = register(self.host, self.port, self.username, self.password)
+			except (socket.error, EOFError, chat_frames.FrameError, RegistrationError):
+				#  The server may still hold our old name until it notices the old connection has gone
+				delay = min(delay * 2, RECONNECT_MAX_DELAY)
+				continue
+			#  The OK clears the old roster before the new one arrives
+			self.queueFrames([(chat_frames.OK, ''), (chat_frames.NOTICE, 'Reconnected')])
+			return
 	##  Event driven function to retrieve and send data to the server
 	
 	def grabText(self, event): 
@@ -327,78 +491,53 @@ class ChatClient(JFrame):
 		#  Reset the text to be empty and grab focus so that it is ready for new text input
 		self.message.requestFocusInWindow()
 		self.message.setText('')
-		#  Send the message to the server
-		data=text.encode()
-		self.tn.write(data+'\r\n')
+		#  Send the message to the server, if the connection is down the receive loop is already getting a new one
+		data=text.encode('utf-8')
+		try:
+			self.send(chat_frames.encode(chat_frames.CHAT, data))
+		except socket.error:
+			self.appendText('\nNot connected, message not sent\n')
 
 	##  Function to handle appending of messages
 	
 	def appendText(self, message, user=None):
 		'''This function takes care of appending any new messages to the content area
 		'''
-		message_label=JTextArea(message,2,3, font=self.label_2_font)
-		#  If this is a message from the grab text function, create a new label, assign it's colours
-		if user!=None:
-			message_label.setBackground(Color(240,240,240))
-			message_label.setForeground(Color(129,129,129))
-		#  Otherwise set the format for receive function (no user passed in)	
-		else:
-			message_label.setBackground(Color(215,215,215))
-			message_label.setForeground(Color(40,153,153))
-		
-		#  Format and style options for the new message labels	
-		message_label.setEditable(False)
-		message_label.setLineWrap(True)
-		message_label.setWrapStyleWord(True)
-		message_label.setBorder(BorderFactory.createLineBorder( Color(247,246,242),4))
-		#  Sets the positioning of messages
-		self.main_content.setCaretPosition(self.main_content.getDocument().getLength())
-		doc = self.main_content.getStyledDocument()
-		attr=SimpleAttributeSet()
-		self.main_content.insertComponent(message_label)
-		# Essential for jtextarea to be able to stack message
-		doc.insertString( self.main_content.getDocument().getLength(),'\n ', attr)
-		# Not sure if needed
-		self.main_content.repaint()
-		
-		###  This is a late edit so it isn't included in the documentation. Basically trying to dynamically update the number
-		###  of users label at runtime. Works for incrementing the value but not decrementing it.
-		
-		print(message)
-		#  Only split the message if there are enough values to split (greeting messages differ in format to chat messages)
-		try:
-			user, text=message.split(' : ')
-		except:
-			return
-			
-		#print('Split values are %s %s'%(user, text))
-		user=str(user.strip())
-		#print(self.no_users)
-		#print(user+' : '+text)
-		#  If the user already in the list, pass
-		if user in self.no_users:
-			if text == ('User %s amach sa teach !'%user):
-				self.no_users.remove(user)
-				print('User % removed'%user)
-			
+		self.appendMessages([(message, user)])
+	
+	##  Function to append a batch of messages in one model update
+	
+	def appendMessages(self, messages):
+		'''Adds the (message, user) pairs to the list, drops whatever is now beyond the scrollback and scrolls to the end
+		'''
+		#  Messages from the grab text function carry the user, so the renderer can colour them differently
+		self.model.append([(message.strip(), user!=None) for message, user in messages])
+		self.model.evict(self.scrollback)
+		self.main_content.ensureIndexIsVisible(self.model.getSize() - 1)
+	
+	##  Function to recalculate row heights after the list changes width
+	
+	def relayoutMessages(self, event):
+		'''Wrapped rows change height with the width, resetting the fixed cell height makes the list measure them again
+		'''
+		self.main_content.setFixedCellHeight(10)
+		self.main_content.setFixedCellHeight(-1)
+	
+	##  Function to keep the number of users label up to date
+	
+	def updatePresence(self, kind, payload):
+		'''Starts a new roster on registering, then applies roster frames and single online or offline changes to the
+		set of users online
+		'''
+		#  A new registration starts a new roster, which may come in several frames
+		if kind == chat_frames.OK:
+			self.online = set()
+		elif kind == chat_frames.ROSTER:
+			self.online.update(chat_frames.decodeRoster(payload))
+		elif kind == chat_frames.ONLINE:
+			self.online.add(payload)
 		else:
-			#print('User %s not in list'%user)
-			if str(user) == 'You':
-				#print('User is equal to "You"')
-				return 
-			self.no_users.append(user)
-			print('User appended')
-			self.number_users=len(self.no_users)
-			#print('Length of user list is '+str(self.number_users))
-	
-		self.user_label2=JLabel(" Users online : %s "%str(len(self.no_users)),JLabel.RIGHT, font=self.label_2_font)
-		#print('Label created')
-		#print('Attempt to replace label')
-		self.client_layout.replace(self.user_label, self.user_label2) 
-		self.user_label = self.user_label2
-		self.user_label.repaint()
-		self.user_label.revalidate()
-		print('Label updated')
+			self.online.discard(payload)
 	
 	##  Function to control return button press in message field
 
@@ -411,6 +550,87 @@ class ChatClient(JFrame):
 		if key_value == 10:
 			self.grabText(event)
 
+###  MessageListModel class, the messages shown in the main display area (inherits from AbstractListModel)
+
+class MessageListModel(AbstractListModel):
+	'''Holds (text, own message) pairs and tells the list about whole batches at once
+	'''
+	
+	##  Constructor method
+	
+	def __init__(self):
+		'''Creates an empty model
+		'''
+		super(MessageListModel, self).__init__()
+		self.messages=[]
+	
+	##  Built in ListModel methods
+	
+	def getSize(self):
+		return len(self.messages)
+	
+	def getElementAt(self, index):
+		return self.messages[index]
+	
+	##  Function to add a batch of messages to the end
+	
+	def append(self, messages):
+		'''Adds the messages and fires a single event for all of them
+		'''
+		if not messages:
+			return
+		first=len(self.messages)
+		self.messages.extend(messages)
+		self.fireIntervalAdded(self, first, len(self.messages) - 1)
+	
+	##  Function to drop the oldest messages
+	
+	def evict(self, keep):
+		'''Removes messages from the front until at most keep are left, firing a single event
+		'''
+		extra=len(self.messages) - keep
+		if extra <= 0:
+			return
+		del self.messages[:extra]
+		self.fireIntervalRemoved(self, 0, extra - 1)
+
+###  MessageRenderer class, draws one message row of the main display area (implements ListCellRenderer)
+
+class MessageRenderer(ListCellRenderer):
+	'''Reuses one text area for every row instead of keeping a component per message
+	'''
+	
+	##  Constructor method, receives the font for messages
+	
+	def __init__(self, font):
+		'''Creates the text area every row is drawn with
+		'''
+		self.area=JTextArea(font=font)
+		#  Format and style options for the message rows
+		self.area.setEditable(False)
+		self.area.setLineWrap(True)
+		self.area.setWrapStyleWord(True)
+		self.area.setBorder(BorderFactory.createLineBorder( Color(247,246,242),4))
+	
+	##  Built in ListCellRenderer method
+	
+	def getListCellRendererComponent(self, message_list, value, index, selected, focused):
+		'''Sets the text area up for the row, sized to the list's width so wrapped rows get the right height
+		'''
+		text, own = value
+		self.area.setText(text)
+		#  Own messages and received messages are coloured differently
+		if own:
+			self.area.setBackground(Color(240,240,240))
+			self.area.setForeground(Color(129,129,129))
+		else:
+			self.area.setBackground(Color(215,215,215))
+			self.area.setForeground(Color(40,153,153))
+		width=message_list.getWidth()
+		if width > 0:
+			self.area.setSize(width, 1)
+		return self.area
+
 ###  Class to collect key presses, inherits from KeyAdapter
 			
 class Key(KeyAdapter):	
@@ -425,6 +645,87 @@ class Key(KeyAdapter):
 		key=event.getKeyCode()
 		return key		
 
+###  RegistrationError class, raised when the server refuses the user name or password, with the reason to show the user
+
+class RegistrationError(Exception):
+	pass
+
+##  Function to connect to the server and register the user name
+
+def register(host, port, user, password=''):
+	'''Returns the connected socket, its frame decoder and the server greeting, raising RegistrationError if the name or
+	password is refused
+	'''
+	login=user.encode('utf-8')
+	#  The password goes in the same frame as the name after a NUL byte, servers that do not check passwords ignore it
+	if password:
+		login+='\x00' + password.encode('utf-8')
+	sock=socket.create_connection((host, port), CONNECT_TIMEOUT)
+	deadline=time.time() + REGISTER_TIMEOUT
+	try:
+		#  Ask for framed mode and send the username straight after, without waiting for the greeting, so registering
+		#  takes one round trip. The server still greets us with a line but sends frames from then on
+		sock.sendall(chat_frames.HELLO_DEFLATE + '\r\n' + chat_frames.encode(chat_frames.CHAT, login))
+		decoder=chat_frames.FrameDecoder(greeting=True)
+		#  The greeting and the validation of the name come back together
+		kind, greeting = nextFrame(sock, decoder, deadline)
+		kind, payload = nextFrame(sock, decoder, deadline)
+	except:
+		sock.close()
+		raise
+	if kind != chat_frames.OK:
+		sock.close()
+		#  Asked for a password we did not give, or refused the one we did
+		if kind in (chat_frames.PASSWORD, chat_frames.DENIED):
+			raise RegistrationError(BAD_LOGIN)
+		raise RegistrationError(BAD_NAME)
+	#  Registered, from here on the receive loop waits in select rather than on socket timeouts
+	sock.settimeout(None)
+	return sock, decoder, greeting
+
+##  Function to read the next frame from the server
+
+def nextFrame(sock, decoder, deadline=None):
+	'''Returns the next (type, payload) frame, reading from the socket until a whole one has arrived. Given a deadline,
+	raises socket.timeout if the frame is not complete by then
+	'''
+	frame=decoder.next()
+	while frame is None:
+		if deadline is not None:
+			remaining=deadline - time.time()
+			if remaining <= 0:
+				raise socket.timeout('Timed out waiting for the server')
+			sock.settimeout(remaining)
+		data=sock.recv(4096)
+		#  An empty read means the server has closed the connection
+		if not data:
+			raise EOFError('Connection closed by the server')
+		decoder.feed(data)
+		frame=decoder.next()
+	return frame
+
+##  Function to turn a frame from the server into the text shown for it
+
+def formatFrame(kind, payload):
+	'''Returns the display text for the frame, or None for frames that are not shown
+	'''
+	if kind == chat_frames.CHAT:
+		sender, text = chat_frames.decodeChat(payload)
+		return '%s : %s'%(sender, text)
+	if kind == chat_frames.PRIVATE:
+		sender, text = chat_frames.decodeChat(payload)
+		return '%s (private) : %s'%(sender, text)
+	if kind == chat_frames.MENTION:
+		sender, text = chat_frames.decodeChat(payload)
+		return '%s mentioned you : %s'%(sender, text)
+	if kind == chat_frames.JOIN:
+		return 'User %s AnSeo !'%payload
+	if kind == chat_frames.LEAVE:
+		return 'User %s amach sa teach !'%payload
+	if kind == chat_frames.NOTICE:
+		return payload
+	return None
+
 ###  Start the program		
 if __name__ == '__main__':
 	ChatApp()		
@@ -0,0 +1,212 @@
+#!/usr/bin/python
+
+#  asyncio engine for the chat server, selected with --engine asyncio. Runs the same ChatFactory and ChatProtocol as
+#  the Twisted engine: each asyncio connection is wrapped in a transport with the handful of methods the core uses,
+#  and asyncio's flow control callbacks drive the outbound queue the same way a Twisted transport does. Like a Twisted
+#  transport, writes are buffered and handed to the socket once per pass of the loop rather than one send per write.
+#  Uses uvloop when it is installed unless told not to. Python 3 only, and single process, the worker bus needs the
+#  Twisted engine.
+
+import asyncio
+import signal
+import socket
+from concurrent.futures import ThreadPoolExecutor
+
+from twisted.internet import defer, error
+from twisted.internet.address import IPv4Address, IPv6Address
+from twisted.python import failure
+
+from chat_core import TIMER_TICK
+
+#  Largest HTTP request head the metrics endpoint reads
+MAX_REQUEST_HEAD = 8192
+
+###  StreamTransport class, the Twisted style transport ChatProtocol writes to, over an asyncio transport
+
+class StreamTransport(object):
+
+	__slots__ = ('transport', 'loop', 'producer', 'disconnecting', 'pending')
+
+	##  Constructor method, receives the asyncio transport and its loop
+	def __init__(self, transport, loop):
+		self.transport=transport
+		self.loop=loop
+		self.producer=None
+		self.disconnecting=False
+		#  Data written since the last flush, None when no flush is scheduled
+		self.pending=None
+
+	##  Functions to send data, collected until the loop gets round to the flush
+	def write(self, data):
+		if self.pending is None:
+			self.pending=[]
+			self.loop.call_soon(self.flush)
+		self.pending.append(data)
+
+	def writeSequence(self, data):
+		if self.pending is None:
+			self.pending=[]
+			self.loop.call_soon(self.flush)
+		self.pending.extend(data)
+
+	##  Function to hand everything written since the last flush to asyncio in one go
+	def flush(self):
+		'''asyncio buffers whatever the socket will not take straight away and calls pause_writing if that gets too much
+		'''
+		pending, self.pending = self.pending, None
+		if pending and not self.transport.is_closing():
+			self.transport.write(b''.join(pending))
+
+	##  Function to close the connection once everything written so far has been sent
+	def loseConnection(self):
+		self.disconnecting=True
+		if self.pending:
+			self.flush()
+		self.transport.close()
+
+	##  Function to close the connection straight away, dropping anything not sent
+	def abortConnection(self):
+		self.disconnecting=True
+		self.pending=None
+		self.transport.abort()
+
+	##  Functions to give the addresses at either end as Twisted address objects
+	def getPeer(self):
+		return self.address(self.transport.get_extra_info('peername'))
+
+	def getHost(self):
+		return self.address(self.transport.get_extra_info('sockname'))
+
+	def address(self, name):
+		'''Turns an asyncio socket address into the matching Twisted address object
+		'''
+		if name is None:
+			return None
+		if len(name) == 4:
+			return IPv6Address('TCP', name[0], name[1])
+		return IPv4Address('TCP', name[0], name[1])
+
+	##  Functions for the producer that asyncio's pause_writing and resume_writing are passed on to
+	def registerProducer(self, producer, streaming):
+		self.producer=producer
+
+	def unregisterProducer(self):
+		self.producer=None
+
+	##  Functions LineReceiver uses to stop and start reading from the client
+	def pauseProducing(self):
+		self.transport.pause_reading()
+
+	def resumeProducing(self):
+		self.transport.resume_reading()
+
+	def stopProducing(self):
+		self.loseConnection()
+
+	##  Functions to turn TCP keepalive and Nagle's algorithm on or off
+	def setTcpKeepAlive(self, enabled):
+		sock=self.transport.get_extra_info('socket')
+		if sock is not None:
+			sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, int(enabled))
+	
+	def setTcpNoDelay(self, enabled):
+		sock=self.transport.get_extra_info('socket')
+		if sock is not None:
+			sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, int(enabled))
+
+###  ChatStreamProtocol class (inherits from asyncio.Protocol), passes one connection's events on to a ChatProtocol
+
+class ChatStreamProtocol(asyncio.Protocol):
+
+	__slots__ = ('factory', 'chat', 'stream')
+
+	##  Constructor method, receives the ChatFactory
+	def __init__(self, factory):
+		self.factory=factory
+		self.chat=None
+		self.stream=None
+
+	##  Built in asyncio.Protocol methods
+	def connection_made(self, transport):
+		'''Builds the ChatProtocol for the connection and connects it to the wrapped transport
+		'''
+		self.stream=StreamTransport(transport, asyncio.get_event_loop())
+		self.chat=self.factory.buildProtocol(self.stream.getPeer())
+		self.chat.makeConnection(self.stream)
+
+	def data_received(self, data):
+		self.chat.dataReceived(data)
+
+	def eof_received(self):
+		'''Closes our side too, the chat has no use for half closed connections
+		'''
+		return False
+
+	def connection_lost(self, exc):
+		'''Stops the outbound queue and tells the ChatProtocol, as a Twisted transport would
+		'''
+		if self.stream.producer is not None:
+			self.stream.producer.stopProducing()
+		self.chat.connectionLost(failure.Failure(exc if exc is not None else error.ConnectionDone()))
+
+	def pause_writing(self):
+		if self.stream.producer is not None:
+			self.stream.producer.pauseProducing()
+
+	def resume_writing(self):
+		if self.stream.producer is not None:
+			self.stream.producer.resumeProducing()
+
+##  Function to answer one request to the metrics endpoint
+async def serveMetrics(registry, reader, writer):
+	'''Reads the request head, whatever it asks for, and answers with the registry in the text exposition format
+	'''
+	try:
+		await reader.readuntil(b'\r\n\r\n')
+		body=registry.render()
+		writer.write(b'HTTP/1.0 200 OK\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+			b'Content-Length: %d\r\n\r\n' % len(body) + body)
+		await writer.drain()
+	except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+		pass
+	finally:
+		writer.close()
+
+##  Function to run the chat server on an asyncio event loop
+def run(options, factory):
+	'''Listens on the port, turns the factory's timer wheel and runs the loop until the process is told to stop
+	'''
+	if options.uvloop:
+		try:
+			import uvloop
+		except ImportError:
+			pass
+		else:
+			asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+	loop=asyncio.new_event_loop()
+	asyncio.set_event_loop(loop)
+	#  Password hashing runs on a thread pool of the loop's own, there is no reactor thread pool here
+	if factory.auth is not None:
+		executor=ThreadPoolExecutor(options.auth_threads)
+		factory.auth.runInThread=lambda function, *args: defer.Deferred.fromFuture(loop.run_in_executor(executor, function, *args))
+	servers=[loop.run_until_complete(loop.create_server(lambda: ChatStreamProtocol(factory), port=options.port, backlog=1024))]
+	if options.metrics_port > 0:
+		servers.append(loop.run_until_complete(asyncio.start_server(lambda reader, writer: serveMetrics(factory.metrics, reader, writer),
+			options.metrics_interface, options.metrics_port, limit=MAX_REQUEST_HEAD)))
+
+	#  One timer for the whole server, as on the Twisted engine
+	def tick():
+		factory.wheel.advance()
+		loop.call_later(TIMER_TICK, tick)
+	loop.call_later(TIMER_TICK, tick)
+	for number in (signal.SIGINT, signal.SIGTERM):
+		loop.add_signal_handler(number, loop.stop)
+	print('***** Running on %s *****' % type(loop).__module__)
+	try:
+		loop.run_forever()
+	finally:
+		for server in servers:
+			server.close()
+		if factory.log is not None:
+			factory.log.close()
+		loop.close()
@@ -0,0 +1,240 @@
+#!/usr/bin/python
+
+#  Optional password check on registration. Credentials live in a small SQLite database holding a salted PBKDF2 hash
+#  per user name. Hashing is deliberately slow, so every check runs on a thread pool and the event loop only ever sees
+#  a Deferred. Names that have logged in recently are remembered in a bounded LRU cache, keyed on a digest of the name
+#  and password under a secret made fresh for each process along with the stored hash they matched, so a burst of
+#  reconnects costs one cheap digest and one indexed lookup each instead of a full hash. The lookup means removing a
+#  user or changing their password takes effect on the next login, cached or not. Checks that do need the hash are
+#  limited per address, so one address cannot guess passwords faster than LOGIN_RATE, and the number waiting for a
+#  thread is bounded, so a flood of logins is refused instead of queueing without end.
+#
+#  Accounts are managed from the command line
+#
+#      python chat_auth.py users.db add alice
+#      python chat_auth.py users.db remove alice
+
+import argparse
+import binascii
+import getpass
+import hashlib
+import hmac
+import os
+import sqlite3
+import sys
+import threading
+from collections import OrderedDict
+from timeit import default_timer as timer
+
+from twisted.internet import defer, threads
+
+from chat_core import LoginRefused, TokenBucket
+
+#  Hash parameters for new passwords, stored hashes carry their own so these can be raised without a reset
+HASH_NAME = 'sha256'
+ITERATIONS = 200000
+SALT_BYTES = 16
+
+#  Successful logins remembered, and for how long before the password has to be hashed again
+CACHE_SIZE = 10000
+CACHE_SECONDS = 600
+
+#  Threads hashing passwords at once, and checks allowed to wait for one of them before further logins are refused
+AUTH_THREADS = 4
+MAX_PENDING = 64
+
+#  Hashed checks each source address may ask for, per second and at once, and the most addresses tracked
+LOGIN_RATE = 0.2
+LOGIN_BURST = 10
+LOGIN_ADDRESSES = 10000
+
+##  Function to hash a password for storing
+def hashPassword(password, salt=None, iterations=ITERATIONS):
+	'''Returns the hash as text, laid out as pbkdf2_<hash>$<iterations>$<salt>$<digest> with salt and digest in hex
+	'''
+	if salt is None:
+		salt=os.urandom(SALT_BYTES)
+	digest=hashlib.pbkdf2_hmac(HASH_NAME, password, salt, iterations)
+	return 'pbkdf2_%s$%d$%s$%s' % (HASH_NAME, iterations, binascii.hexlify(salt).decode('ascii'),
+		binascii.hexlify(digest).decode('ascii'))
+
+##  Function to check a password against a stored hash
+def verifyPassword(password, stored):
+	'''Hashes the password with the stored salt and parameters, returns True if it matches
+	'''
+	try:
+		scheme, iterations, salt, digest = stored.split('$')
+		if not scheme.startswith('pbkdf2_'):
+			return False
+		expected=binascii.unhexlify(digest)
+		actual=hashlib.pbkdf2_hmac(scheme[len('pbkdf2_'):], password, binascii.unhexlify(salt), int(iterations))
+	except (ValueError, TypeError, binascii.Error):
+		return False
+	return hmac.compare_digest(actual, expected)
+
+#  Checked against when the name is unknown, so a missing user takes as long to refuse as a wrong password
+DUMMY_HASH = hashPassword(b'', b'\x00' * SALT_BYTES)
+
+###  CredentialStore class, the SQLite table of user names and password hashes
+
+class CredentialStore(object):
+
+	##  Constructor method, receives the path of the database, created if it does not exist
+	def __init__(self, path):
+		'''Opens the database for use from any thread, one query at a time
+		'''
+		self.path=path
+		self.lock=threading.Lock()
+		self.db=sqlite3.connect(path, check_same_thread=False)
+		with self.lock:
+			self.db.execute('CREATE TABLE IF NOT EXISTS users (name BLOB PRIMARY KEY, hash TEXT NOT NULL)')
+			self.db.commit()
+
+	##  Function to get a user's stored hash
+	def lookup(self, name):
+		'''Returns the hash, or None if there is no such user
+		'''
+		with self.lock:
+			row=self.db.execute('SELECT hash FROM users WHERE name = ?', (sqlite3.Binary(name),)).fetchone()
+		return row[0] if row is not None else None
+
+	##  Function to add a user or change their password
+	def set(self, name, password):
+		with self.lock:
+			self.db.execute('INSERT OR REPLACE INTO users (name, hash) VALUES (?, ?)', (sqlite3.Binary(name), hashPassword(password)))
+			self.db.commit()
+
+	##  Function to delete a user
+	def remove(self, name):
+		'''Returns True if there was such a user
+		'''
+		with self.lock:
+			removed=self.db.execute('DELETE FROM users WHERE name = ?', (sqlite3.Binary(name),)).rowcount
+			self.db.commit()
+		return removed > 0
+
+	##  Function to close the database
+	def close(self):
+		with self.lock:
+			self.db.close()
+
+###  Authenticator class, checks names and passwords for the ChatFactory
+
+class Authenticator(object):
+
+	##  Constructor method, receives the credential store and the cache limits
+	def __init__(self, store, cache_size=CACHE_SIZE, cache_seconds=CACHE_SECONDS, max_pending=MAX_PENDING,
+			login_rate=LOGIN_RATE, login_burst=LOGIN_BURST, clock=timer):
+		'''Checks run on the reactor's thread pool unless the engine swaps runInThread for its own
+		'''
+		self.store=store
+		self.cache_size=cache_size
+		self.cache_seconds=cache_seconds
+		self.clock=clock
+		#  Hashed checks handed to the threads and not answered yet
+		self.max_pending=max_pending
+		self.pending=0
+		#  Address to token bucket of hashed checks, least recently used first. Unlike the line limit's buckets these
+		#  outlive the connection, so reconnecting does not buy more guesses
+		self.login_rate=login_rate
+		self.login_burst=login_burst
+		self.buckets=OrderedDict()
+		#  Name to (digest, stored hash, expiry) of each recent successful login, least recently used first
+		self.cache=OrderedDict()
+		self.secret=os.urandom(32)
+		self.runInThread=threads.deferToThread
+
+	##  Function to check a name and password
+	def verify(self, name, password, address=None):
+		'''Returns a Deferred firing with True if the password is right, straight away when the login is in the cache.
+		It fails with LoginRefused when the address has used up its checks or too many are already waiting
+		'''
+		key=hmac.new(self.secret, name + b'\x00' + password, hashlib.sha256).digest()
+		entry=self.cache.pop(name, None)
+		if entry is not None:
+			#  The store is read on the event loop here, one primary key lookup, so a removed user or a changed
+			#  password is not let in on the strength of the cache
+			if hmac.compare_digest(entry[0], key) and entry[2] > self.clock() and self.store.lookup(name) == entry[1]:
+				self.cache[name]=entry
+				return defer.succeed(True)
+		if not self.allowCheck(address):
+			return defer.fail(LoginRefused('Too many login attempts, try again later'))
+		if self.pending >= self.max_pending:
+			return defer.fail(LoginRefused('Server busy, try again later'))
+		self.pending+=1
+		d=self.runInThread(self.check, name, password)
+		d.addBoth(self.done)
+		d.addCallback(self.checked, name, key)
+		return d
+	
+	##  Function to charge a hashed check to the address asking for it
+	def allowCheck(self, address):
+		'''Returns True if the address has a check left, forgetting the least recently used addresses beyond
+		LOGIN_ADDRESSES
+		'''
+		if self.login_rate <= 0 or address is None:
+			return True
+		bucket=self.buckets.pop(address, None)
+		if bucket is None:
+			bucket=TokenBucket(self.login_rate, self.login_burst, self.clock)
+			if len(self.buckets) >= LOGIN_ADDRESSES:
+				self.buckets.popitem(last=False)
+		self.buckets[address]=bucket
+		return bucket.take()
+	
+	##  Function to count a hashed check as answered, whatever the answer
+	def done(self, result):
+		self.pending-=1
+		return result
+
+	##  Function to check a password against the store, run on a pool thread
+	def check(self, name, password):
+		'''Returns whether the password is right and the stored hash it was checked against
+		'''
+		stored=self.store.lookup(name)
+		if stored is None:
+			verifyPassword(password, DUMMY_HASH)
+			return False, None
+		return verifyPassword(password, stored), stored
+
+	##  Function to remember a successful check
+	def checked(self, result, name, key):
+		'''Caches the login, dropping the least recently used ones beyond the cache size, and passes the result on
+		'''
+		valid, stored = result
+		if valid and self.cache_size > 0:
+			self.cache[name]=(key, stored, self.clock() + self.cache_seconds)
+			while len(self.cache) > self.cache_size:
+				self.cache.popitem(last=False)
+		return valid
+
+##  Function to parse the command line
+def parseArgs(argv):
+	'''Returns the account management options
+	'''
+	parser=argparse.ArgumentParser(description='Manage An Seo chat accounts')
+	parser.add_argument('database', help='SQLite credential store, as passed to chat_server.py --auth-db')
+	parser.add_argument('action', choices=('add', 'remove'), help='add a user or change their password, or remove a user')
+	parser.add_argument('name', help='user name')
+	return parser.parse_args(argv)
+
+##  Main function, adds or removes one account
+def main(argv=None):
+	'''Prompts for the password when adding
+	'''
+	options=parseArgs(sys.argv[1:] if argv is None else argv)
+	name=options.name.encode('utf-8')
+	store=CredentialStore(options.database)
+	try:
+		if options.action == 'add':
+			password=getpass.getpass('Password for %s: ' % options.name)
+			if password != getpass.getpass('Again: '):
+				raise SystemExit('Passwords do not match')
+			store.set(name, password.encode('utf-8'))
+		elif not store.remove(name):
+			raise SystemExit('No user named %s' % options.name)
+	finally:
+		store.close()
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,499 @@
+#!/usr/bin/python
+
+#  Load generator and latency benchmark for the chat server. Starts chat_server.py as a child process on a loopback
+#  port, connects a few thousand simulated clients that register and chat exactly as real clients do, then reports
+#  throughput, fan-out latency percentiles and the server's memory and CPU use. Linux only, it reads /proc.
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import resource
+import socket
+import subprocess
+import sys
+import time
+from array import array
+from timeit import default_timer as timer
+
+from twisted.internet import reactor, task
+from twisted.internet.protocol import Protocol, ClientFactory
+
+import chat_frames
+
+SERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'chat_server.py')
+
+#  Prefix of the chat lines the benchmark sends, followed by the sequence number and send time
+MARK = b'bench'
+
+#  Text the lines are padded out with when --message-bytes asks for longer messages
+FILLER = (b'the quick brown fox jumps over the lazy dog while the chat room talks about lunch, the weather, '
+	b'the match last night and whether anyone has seen the latest build of the server running on the test box. ')
+
+###  BenchClient class, one simulated user
+
+class BenchClient(Protocol):
+
+	##  Constructor method, receives the benchmark, the user name and the room to join
+	def __init__(self, bench, name, room):
+		'''Sets the client up in line or framed mode to match the benchmark
+		'''
+		self.bench=bench
+		self.name=name
+		self.room=room
+		self.registered=False
+		self.buffer=b''
+		self.decoder=chat_frames.FrameDecoder(greeting=True) if bench.framed else None
+
+	##  Connected to the server. Built in Protocol method
+	def connectionMade(self):
+		'''Sends the user name straight away, asking for framed mode first if the benchmark uses it
+		'''
+		if self.decoder is not None:
+			self.transport.write((chat_frames.HELLO_DEFLATE if self.bench.deflate else chat_frames.HELLO) + b'\r\n')
+		self.send(self.name)
+
+	##  Function to send one line of input to the server
+	def send(self, line):
+		'''Writes the line in whichever format this connection uses
+		'''
+		if self.decoder is not None:
+			self.transport.write(chat_frames.encode(chat_frames.CHAT, line))
+		else:
+			self.transport.write(line + b'\r\n')
+
+	##  Handles data from the server. Built in Protocol method
+	def dataReceived(self, data):
+		'''Splits the data into lines or frames and hands each to the matching handler
+		'''
+		self.bench.received+=len(data)
+		if self.decoder is not None:
+			for kind, payload in self.decoder.frames(data):
+				if kind == chat_frames.CHAT:
+					self.chatReceived(chat_frames.decodeChat(payload)[1])
+				elif kind in (chat_frames.OK, chat_frames.TAKEN):
+					self.registrationAnswered(kind == chat_frames.OK)
+			return
+		self.buffer+=data
+		lines=self.buffer.split(b'\r\n')
+		self.buffer=lines.pop()
+		for line in lines:
+			if line == b'OK<':
+				self.registrationAnswered(True)
+			elif line == b'>>> Username taken! <<<':
+				self.registrationAnswered(False)
+			elif line.startswith(b'>>>') and b' : ' in line:
+				self.chatReceived(line.split(b' : ', 1)[1][:-5])
+
+	##  Function to handle the server's answer to the user name
+	def registrationAnswered(self, accepted):
+		'''Moves the user into its room and tells the benchmark it is ready
+		'''
+		if not accepted:
+			self.bench.fail('User name %r was refused' % (self.name,))
+			return
+		self.registered=True
+		if self.room is not None:
+			self.send(b'/join ' + self.room)
+		self.bench.clientReady(self)
+
+	##  Function to handle a chat line from another user
+	def chatReceived(self, text):
+		'''Records the fan-out latency of benchmark lines
+		'''
+		if text.startswith(MARK):
+			self.bench.delivered(timer() - float(text.split()[2]))
+
+###  BenchClientFactory class (inherits from ClientFactory), creates the simulated users
+
+class BenchClientFactory(ClientFactory):
+
+	##  Constructor method, receives the benchmark
+	def __init__(self, bench):
+		self.bench=bench
+
+	##  Returns the next simulated user. Built in Factory method
+	def buildProtocol(self, addr):
+		'''This function returns a BenchClient with the next free name and room
+		'''
+		return self.bench.nextClient()
+
+	##  A client could not connect. Built in ClientFactory method
+	def clientConnectionFailed(self, connector, reason):
+		'''Connecting is part of what is being measured, so a failure ends the run
+		'''
+		self.bench.fail('Connection failed: %s' % reason.getErrorMessage())
+
+###  Benchmark class, runs one benchmark against a server process
+
+class Benchmark(object):
+
+	##  Constructor method, receives the parsed command line and the server's process id
+	def __init__(self, options, server_pid):
+		'''Sets up the counters, latencies are kept as a flat array of floats to keep the harness itself light
+		'''
+		self.options=options
+		self.deflate=options.deflate
+		self.framed=options.framed or options.deflate
+		#  Bytes read by every client, to compare the bandwidth of the wire formats
+		self.received=0
+		self.padding=b''
+		if options.message_bytes > 0:
+			self.padding=b' ' + (FILLER * (options.message_bytes // len(FILLER) + 1))[:options.message_bytes]
+		self.server_pid=server_pid
+		self.clients=[]
+		self.ready=0
+		self.sent=0
+		self.latencies=array('d')
+		self.senders=[]
+		self.result=None
+		self.error=None
+
+	##  Function to start connecting the simulated users
+	def start(self):
+		'''Connects every client, in batches so the server's accept queue is not overrun
+		'''
+		self.rss_idle=serverMemory(self.server_pid)
+		self.connect_started=timer()
+		factory=BenchClientFactory(self)
+		batch=self.options.connect_batch
+		for first in range(0, self.options.clients, batch):
+			reactor.callLater(first // batch * 0.05, self.connectBatch, factory, min(batch, self.options.clients - first))
+
+	##  Function to open one batch of connections
+	def connectBatch(self, factory, count):
+		'''Opens count connections to the server
+		'''
+		for i in range(count):
+			reactor.connectTCP('127.0.0.1', self.options.port, factory)
+
+	##  Function to build the next simulated user
+	def nextClient(self):
+		'''Names the users in order and spreads them evenly across the rooms
+		'''
+		number=len(self.clients)
+		room=None
+		if self.options.rooms > 1:
+			room=b'room%d' % (number % self.options.rooms)
+		client=BenchClient(self, b'bench%d' % number, room)
+		self.clients.append(client)
+		return client
+
+	##  Called by each client once it is registered
+	def clientReady(self, client):
+		'''Starts sending once every client is registered and in its room
+		'''
+		self.ready+=1
+		if self.ready == self.options.clients:
+			self.connect_time=timer() - self.connect_started
+			#  Give the room joins a moment to land before measuring
+			reactor.callLater(1.0, self.measureIdle if self.options.idle else self.startSending)
+
+	##  Function to measure the server with every user connected and nobody talking
+	def measureIdle(self):
+		'''Samples the server's memory a few times, keeping the lowest, and reports it without sending anything
+		'''
+		samples=[]
+		for i in range(5):
+			samples.append(serverMemory(self.server_pid))
+			time.sleep(0.2)
+		self.rss_loaded=min(samples)
+		options=self.options
+		self.result={
+			'config': {
+				'clients': options.clients,
+				'rooms': options.rooms,
+				'framing': self.framing(),
+				'idle': True,
+				'server_args': options.server_args,
+			},
+			'connect_seconds': round(self.connect_time, 3),
+			'server': {
+				'rss_idle_kb': self.rss_idle // 1024,
+				'rss_loaded_kb': self.rss_loaded // 1024,
+				'bytes_per_connection': (self.rss_loaded - self.rss_idle) // options.clients,
+			},
+		}
+		reactor.stop()
+	
+	##  Function to name the wire format in use
+	def framing(self):
+		return 'deflate' if self.deflate else 'framed' if self.framed else 'line'
+	
+	##  Function to start the chat traffic
+	def startSending(self):
+		'''Starts a timed loop on each sender and schedules the end of the run
+		'''
+		self.rss_loaded=serverMemory(self.server_pid)
+		self.cpu_started=serverCpu(self.server_pid)
+		self.received_started=self.received
+		self.segments_started=tcpSegments()
+		self.send_started=timer()
+		interval=1.0 / self.options.rate
+		for client in self.clients[:self.options.senders]:
+			loop=task.LoopingCall(self.sendOne, client)
+			loop.start(interval, now=False)
+			self.senders.append(loop)
+		reactor.callLater(self.options.duration, self.stopSending)
+
+	##  Function to send one benchmark line
+	def sendOne(self, client):
+		'''Sends a line carrying the sequence number and the time it was sent
+		'''
+		self.sent+=1
+		client.send(b'%s %d %.9f%s' % (MARK, self.sent, timer(), self.padding))
+
+	##  Function to stop the chat traffic
+	def stopSending(self):
+		'''Stops the senders and leaves time for the last lines to arrive
+		'''
+		for loop in self.senders:
+			loop.stop()
+		self.send_time=timer() - self.send_started
+		self.cpu_used=serverCpu(self.server_pid) - self.cpu_started
+		reactor.callLater(self.options.drain, self.finish)
+
+	##  Called by a client for every benchmark line it receives
+	def delivered(self, latency):
+		'''Records the latency of one delivery
+		'''
+		self.latencies.append(latency)
+
+	##  Function to stop the run on an error
+	def fail(self, error):
+		'''Records the error and stops the reactor
+		'''
+		if self.error is None:
+			self.error=error
+			print(error, file=sys.stderr)
+			if reactor.running:
+				reactor.stop()
+
+	##  Function to work out the results and stop the reactor
+	def finish(self):
+		'''Builds the machine readable result
+		'''
+		options=self.options
+		per_room=float(options.clients) / max(options.rooms, 1)
+		latencies=sorted(self.latencies)
+		segments=tcpSegments() - self.segments_started
+		self.result={
+			'config': {
+				'clients': options.clients,
+				'senders': options.senders,
+				'rooms': options.rooms,
+				'rate_per_sender': options.rate,
+				'duration': options.duration,
+				'framing': self.framing(),
+				'message_bytes': options.message_bytes,
+				'server_args': options.server_args,
+			},
+			'connect_seconds': round(self.connect_time, 3),
+			'bytes_received': self.received - self.received_started,
+			'bytes_per_delivery': round(float(self.received - self.received_started) / max(len(latencies), 1), 1),
+			'tcp_segments': segments,
+			'tcp_segments_per_delivery': round(float(segments) / max(len(latencies), 1), 3),
+			'messages_sent': self.sent,
+			'messages_per_sec': round(self.sent / self.send_time, 1),
+			'deliveries': len(latencies),
+			'expected_deliveries': int(round(self.sent * (per_room - 1))),
+			'deliveries_per_sec': round(len(latencies) / self.send_time, 1),
+			'latency_ms': {
+				'p50': percentile(latencies, 0.50),
+				'p99': percentile(latencies, 0.99),
+				'p999': percentile(latencies, 0.999),
+				'max': percentile(latencies, 1.0),
+			},
+			'server': {
+				'rss_idle_kb': self.rss_idle // 1024,
+				'rss_loaded_kb': self.rss_loaded // 1024,
+				'bytes_per_connection': (self.rss_loaded - self.rss_idle) // options.clients,
+				'cpu_seconds': round(self.cpu_used, 3),
+				'cpu_percent': round(100.0 * self.cpu_used / self.send_time, 1),
+			},
+		}
+		reactor.stop()
+
+##  Function to pick a percentile out of sorted latencies
+def percentile(latencies, fraction):
+	'''Returns the latency at the fraction in milliseconds, or None if nothing was delivered
+	'''
+	if not latencies:
+		return None
+	return round(latencies[int(fraction * (len(latencies) - 1))] * 1000.0, 3)
+
+##  Function to list a process and all of its descendants
+def processTree(pid):
+	'''Returns the pid along with the pids of its children, their children and so on, so --workers is measured in full
+	'''
+	pids=[pid]
+	for current in pids:
+		try:
+			for tid in os.listdir('/proc/%d/task' % current):
+				with open('/proc/%d/task/%s/children' % (current, tid)) as children:
+					pids.extend(int(child) for child in children.read().split())
+		except (IOError, OSError):
+			pass
+	return pids
+
+##  Function to read the resident memory of the server
+def serverMemory(pid):
+	'''Returns the resident set size in bytes summed over the server's processes
+	'''
+	total=0
+	for current in processTree(pid):
+		try:
+			with open('/proc/%d/status' % current) as status:
+				for line in status:
+					if line.startswith('VmRSS:'):
+						total+=int(line.split()[1]) * 1024
+		except (IOError, OSError):
+			pass
+	return total
+
+##  Function to read the CPU time used by the server
+def serverCpu(pid):
+	'''Returns user plus system CPU seconds summed over the server's processes
+	'''
+	ticks=os.sysconf('SC_CLK_TCK')
+	total=0.0
+	for current in processTree(pid):
+		try:
+			with open('/proc/%d/stat' % current) as stat:
+				fields=stat.read().rsplit(')', 1)[1].split()
+			total+=(int(fields[11]) + int(fields[12])) / float(ticks)
+		except (IOError, OSError):
+			pass
+	return total
+
+##  Function to read how many TCP segments the host has sent
+def tcpSegments():
+	'''Returns the OutSegs counter from /proc/net/snmp, which counts every TCP connection on the host, the benchmark's
+	clients included, so it is only meaningful on an otherwise quiet machine. Returns 0 where the file does not exist
+	'''
+	try:
+		with open('/proc/net/snmp') as snmp:
+			rows=[line.split() for line in snmp if line.startswith('Tcp:')]
+	except (IOError, OSError):
+		return 0
+	return int(dict(zip(rows[0], rows[1]))['OutSegs'])
+
+##  Function to start the server under test
+def startServer(options):
+	'''Runs chat_server.py on the benchmark port and waits until it accepts connections
+	'''
+	command=[sys.executable, SERVER, '--port', str(options.port)] + options.server_args
+	server=subprocess.Popen(command, stdout=open(os.devnull, 'w'))
+	deadline=time.time() + 10
+	while time.time() < deadline:
+		try:
+			socket.create_connection(('127.0.0.1', options.port), 0.5).close()
+			#  Give --workers mode time to bring every worker up
+			time.sleep(0.5)
+			return server
+		except socket.error:
+			if server.poll() is not None:
+				break
+			time.sleep(0.1)
+	server.kill()
+	raise SystemExit('Server did not start')
+
+##  Function to raise the open file limit so thousands of sockets can be opened
+def raiseFileLimit():
+	'''Lifts the soft limit on open files to the hard limit, the server inherits it too
+	'''
+	soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+	resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+##  Function to parse the command line
+def parseArgs(argv):
+	'''Returns the benchmark options
+	'''
+	parser=argparse.ArgumentParser(description='Load and latency benchmark for the An Seo chat server')
+	parser.add_argument('--clients', type=int, default=1000, help='number of simulated users')
+	parser.add_argument('--senders', type=int, default=10, help='how many of the users send messages')
+	parser.add_argument('--rate', type=float, default=20.0, help='messages per second from each sender')
+	parser.add_argument('--duration', type=float, default=10.0, help='seconds of chat traffic')
+	parser.add_argument('--drain', type=float, default=2.0, help='seconds to wait for the last messages to arrive')
+	parser.add_argument('--rooms', type=int, default=1, help='spread the users evenly across this many rooms')
+	parser.add_argument('--framed', action='store_true', help='use framed mode instead of telnet lines')
+	parser.add_argument('--deflate', action='store_true', help='use framed mode and ask the server to compress what it sends')
+	parser.add_argument('--message-bytes', type=int, default=0, help='pad each benchmark line with this many bytes of text')
+	parser.add_argument('--idle', action='store_true', help='only connect and register the users, then report the server\'s memory per idle connection')
+	parser.add_argument('--connect-batch', type=int, default=200, help='connections opened every 50ms')
+	parser.add_argument('--port', type=int, default=60101, help='loopback port for the server under test')
+	parser.add_argument('--server-arg', dest='server_args', action='append', default=[], help='extra argument for chat_server.py, may be repeated')
+	parser.add_argument('--engines', help='comma separated server engines (twisted, asyncio) to run the same benchmark on one after the other')
+	parser.add_argument('--output', help='also write the JSON result to this file')
+	return parser.parse_args(argv)
+
+##  Main function, runs one benchmark and prints the result as JSON
+def main(argv=None):
+	'''Starts the server, runs the benchmark against it and reports the result
+	'''
+	if argv is None:
+		argv=sys.argv[1:]
+	options=parseArgs(argv)
+	if options.engines:
+		writeResult(options, compareEngines(options, argv))
+		return
+	raiseFileLimit()
+	server=startServer(options)
+	bench=Benchmark(options, server.pid)
+	try:
+		reactor.callWhenRunning(bench.start)
+		reactor.run()
+	finally:
+		server.terminate()
+		server.wait()
+	if bench.result is None:
+		raise SystemExit(bench.error or 'Benchmark did not finish')
+	writeResult(options, bench.result)
+
+##  Function to print a result and write it to the --output file if there is one
+def writeResult(options, result):
+	'''Prints the result as JSON
+	'''
+	output=json.dumps(result, indent=2, sort_keys=True)
+	print(output)
+	if options.output:
+		with open(options.output, 'w') as handle:
+			handle.write(output + '\n')
+
+##  Function to run the benchmark once for each engine
+def compareEngines(options, argv):
+	'''Runs this script for each engine in its own process, the reactor cannot be started twice, and returns the
+	results side by side with a summary of the headline numbers
+	'''
+	#  The child runs get the same arguments, apart from the ones that only make sense here
+	args=[]
+	skip=False
+	for arg in argv:
+		if skip:
+			skip=False
+		elif arg in ('--engines', '--output'):
+			skip=True
+		elif not arg.startswith(('--engines=', '--output=')):
+			args.append(arg)
+	results={}
+	for engine in options.engines.split(','):
+		child=subprocess.Popen([sys.executable, os.path.abspath(__file__)] + args + ['--server-arg=--engine', '--server-arg=' + engine],
+			stdout=subprocess.PIPE)
+		output=child.communicate()[0]
+		if child.returncode != 0:
+			raise SystemExit('Benchmark of the %s engine failed' % engine)
+		results[engine]=json.loads(output.decode('utf-8'))
+	summary={}
+	for engine, result in results.items():
+		server=result['server']
+		summary[engine]={
+			'deliveries_per_sec': result.get('deliveries_per_sec'),
+			'p99_ms': result.get('latency_ms', {}).get('p99'),
+			'cpu_percent': server.get('cpu_percent'),
+			'bytes_per_connection': server['bytes_per_connection'],
+		}
+	return {'engines': results, 'summary': summary}
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,235 @@
+#!/usr/bin/python
+
+#  Local message bus used when the server runs as several worker processes. The master process runs the hub on a
+#  UNIX socket, each worker connects to it to claim user names cluster wide and to forward broadcasts to the others
+#  and messages meant for one user to the worker that user is on.
+
+import struct
+from collections import deque
+from twisted.internet import defer, reactor
+from twisted.internet.error import ReactorNotRunning
+from twisted.internet.protocol import Factory, ClientFactory
+from twisted.protocols.basic import Int32StringReceiver
+
+#  One byte message types carried on the bus, the rest of each message is the payload
+CLAIM = b'C'
+CLAIMED = b'K'
+TAKEN = b'T'
+RELEASE = b'R'
+JOIN = b'J'
+LEAVE = b'L'
+BROADCAST = b'B'
+DIRECT = b'D'
+
+#  Largest single bus message we accept
+MAX_BUS_MESSAGE = 1024 * 1024
+
+###  BusHubProtocol class, the hub's end of the connection to one worker
+
+class BusHubProtocol(Int32StringReceiver):
+
+	MAX_LENGTH = MAX_BUS_MESSAGE
+
+	##  Constructor method, receives the hub as an argument
+	def __init__(self, hub):
+		'''Keeps track of the hub and of the names this worker holds
+		'''
+		self.hub=hub
+		self.names=set()
+
+	##  A worker has connected. Built in Protocol method
+	def connectionMade(self):
+		'''Registers the worker and sends it every name already online elsewhere
+		'''
+		self.hub.workers.add(self)
+		for name in self.hub.names:
+			self.sendString(JOIN + name)
+
+	##  A worker has gone away. Built in Protocol method
+	def connectionLost(self, reason):
+		'''Frees up every name the worker held so they can be used again
+		'''
+		self.hub.workers.discard(self)
+		for name in self.names:
+			self.hub.release(self, name)
+		self.names.clear()
+
+	##  Handles one message from a worker. Built in Int32StringReceiver method
+	def stringReceived(self, string):
+		'''Dispatches the message on its type byte
+		'''
+		kind, payload = string[:1], string[1:]
+		if kind == CLAIM:
+			if self.hub.claim(self, payload):
+				self.names.add(payload)
+				self.sendString(CLAIMED + payload)
+			else:
+				self.sendString(TAKEN + payload)
+		elif kind == RELEASE:
+			if payload in self.names:
+				self.names.discard(payload)
+				self.hub.release(self, payload)
+		elif kind == BROADCAST:
+			self.hub.forward(self, string)
+		elif kind == DIRECT:
+			size=struct.unpack('!B', payload[:1])[0]
+			worker=self.hub.names.get(payload[1:size + 1])
+			if worker is not None and worker is not self:
+				worker.sendString(string)
+
+###  BusHub class (inherits from Factory), holds the cluster wide name registry in the master process
+
+class BusHub(Factory):
+
+	##  Constructor method, creates the registry and the set of connected workers
+	def __init__(self):
+		#  Every name in use and the worker holding it
+		self.names={}
+		self.workers=set()
+
+	##  Returns a BusHubProtocol for each worker. Built in Factory method
+	def buildProtocol(self, addr):
+		'''This function returns an instance of BusHubProtocol for each worker received
+		'''
+		return BusHubProtocol(self)
+
+	##  Function to claim a name for a worker
+	def claim(self, worker, name):
+		'''Returns True and tells the other workers about the name if it was free, False if it is in use
+		'''
+		if name in self.names:
+			return False
+		self.names[name]=worker
+		self.forward(worker, JOIN + name)
+		return True
+
+	##  Function to free a name held by a worker
+	def release(self, worker, name):
+		'''Drops the name from the registry and tells the other workers it has gone
+		'''
+		if self.names.get(name) is worker:
+			del self.names[name]
+		self.forward(worker, LEAVE + name)
+
+	##  Function to pass a message to every worker except the one it came from
+	def forward(self, source, string):
+		'''Sends the already framed message on to all other workers
+		'''
+		for worker in self.workers:
+			if worker is not source:
+				worker.sendString(string)
+
+###  BusClient class, the worker's end of the bus
+
+class BusClient(Int32StringReceiver):
+
+	MAX_LENGTH = MAX_BUS_MESSAGE
+
+	##  Constructor method, receives the worker's ChatFactory as an argument
+	def __init__(self, chat):
+		'''Keeps the chat factory and the claims still waiting on the hub
+		'''
+		self.chat=chat
+		self.pending=deque()
+
+	##  Connected to the hub. Built in Protocol method
+	def connectionMade(self):
+		'''Attaches the bus to the chat factory so broadcasts and registrations start using it
+		'''
+		self.chat.attachBus(self)
+
+	##  Lost the hub, the master has gone away. Built in Protocol method
+	def connectionLost(self, reason):
+		'''Fails any outstanding claims and detaches from the chat factory
+		'''
+		pending, self.pending = self.pending, deque()
+		for d in pending:
+			d.errback(reason)
+		self.chat.detachBus(self)
+
+	##  Function to ask the hub for a name
+	def claim(self, name):
+		'''Returns a Deferred that fires with True if the name was claimed and False if it is taken
+		'''
+		d=defer.Deferred()
+		#  The hub answers claims in the order they were sent, so a queue is enough to match up the replies
+		self.pending.append(d)
+		self.sendString(CLAIM + name)
+		return d
+
+	##  Function to give a name back to the hub
+	def release(self, name):
+		'''Tells the hub the user has left this worker
+		'''
+		self.sendString(RELEASE + name)
+
+	##  Function to forward a broadcast to the other workers
+	def broadcast(self, room, frame):
+		'''Sends the room and the message's framed encoding so every worker can fan it out to its own members of the room
+		'''
+		self.sendString(BROADCAST + struct.pack('!B', len(room)) + room + frame)
+
+	##  Function to send a message to a user on another worker
+	def direct(self, name, room, frame):
+		'''Sends the user's name, the room the message was said in if any and the message's framed encoding, the hub
+		passes it to the one worker holding the name
+		'''
+		self.sendString(DIRECT + struct.pack('!B', len(name)) + name + struct.pack('!B', len(room)) + room + frame)
+	
+	##  Handles one message from the hub. Built in Int32StringReceiver method
+	def stringReceived(self, string):
+		'''Dispatches the message on its type byte
+		'''
+		kind, payload = string[:1], string[1:]
+		if kind == BROADCAST:
+			size=struct.unpack('!B', payload[:1])[0]
+			self.chat.receiveBroadcast(payload[1:size + 1], payload[size + 1:])
+		elif kind == DIRECT:
+			size=struct.unpack('!B', payload[:1])[0]
+			name, payload = payload[1:size + 1], payload[size + 1:]
+			size=struct.unpack('!B', payload[:1])[0]
+			self.chat.receiveDirect(name, payload[1:size + 1], payload[size + 1:])
+		elif kind == JOIN:
+			self.chat.remoteOnline(payload)
+		elif kind == LEAVE:
+			self.chat.remoteOffline(payload)
+		elif kind in (CLAIMED, TAKEN):
+			self.pending.popleft().callback(kind == CLAIMED)
+
+###  BusClientFactory class (inherits from ClientFactory), connects a worker's ChatFactory to the hub
+
+class BusClientFactory(ClientFactory):
+
+	##  Constructor method, receives the worker's ChatFactory as an argument
+	def __init__(self, chat):
+		self.chat=chat
+
+	##  Returns the BusClient for the connection. Built in Factory method
+	def buildProtocol(self, addr):
+		'''This function returns the BusClient for the worker
+		'''
+		return BusClient(self.chat)
+
+	##  The hub could not be reached. Built in ClientFactory method
+	def clientConnectionFailed(self, connector, reason):
+		'''A worker is no use without the hub, stop it so the master can see the failure
+		'''
+		print('Could not reach the worker bus: %s' % reason.getErrorMessage())
+		stopWorker()
+
+	##  The hub has gone away, which means the master has too. Built in ClientFactory method
+	def clientConnectionLost(self, connector, reason):
+		'''Stops the worker rather than letting it run with a stale view of the other workers
+		'''
+		print('Lost the worker bus, shutting down')
+		#  Let a shutdown the master has already signalled run first
+		reactor.callLater(0, stopWorker)
+
+##  Function to stop the worker's reactor
+def stopWorker():
+	'''Stops the reactor unless it is already on its way down
+	'''
+	try:
+		reactor.stop()
+	except ReactorNotRunning:
+		pass
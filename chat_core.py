@@ -0,0 +1,1199 @@
+#!/usr/bin/python
+
+#  The chat itself, independent of the event loop it runs on. ChatProtocol only needs a transport with write,
+#  writeSequence, loseConnection, abortConnection, getPeer and registerProducer, and something that calls
+#  ChatFactory.wheel.advance once every TIMER_TICK seconds. chat_server.py runs it on the Twisted reactor and
+#  chat_asyncio.py on an asyncio event loop.
+
+import re
+from collections import deque
+from timeit import default_timer as timer
+from zope.interface import implementer
+from twisted.internet import defer
+from twisted.internet.interfaces import IPushProducer
+from twisted.internet.protocol import Factory
+from twisted.protocols.basic import LineReceiver
+import chat_frames
+from chat_metrics import ChatMetrics
+
+#  Default limits for the data held back for a client that is not reading
+MAX_QUEUE_BYTES = 256 * 1024
+MAX_QUEUE_MESSAGES = 1000
+
+#  Encoding profiles, the wire format a client has asked for
+LINE = 'line'
+FRAMED = 'framed'
+DEFLATE = 'deflate'
+
+#  Frames shorter than this are sent to deflate clients as they are, compressing them would not save anything
+DEFLATE_MIN = 128
+DEFLATE_LEVEL = 6
+
+#  Longest user name accepted, it has to fit the one byte length in a chat frame
+MAX_NAME_LENGTH = 32
+#  Largest frame a client may send. The server adds the sender's name and its length byte to a chat message before
+#  passing it on, and what it passes on has to fit in a frame too
+MAX_CLIENT_FRAME = chat_frames.MAX_FRAME_LENGTH - 2 - MAX_NAME_LENGTH
+#  Bytes a user or room name may not contain, control bytes would break the roster and the lines sent to telnet clients
+INVALID_NAME = re.compile(br'[\x00-\x1f\x7f]')
+
+#  Room every user starts out in, and the longest room name accepted from a client
+DEFAULT_ROOM = b'lobby'
+MAX_ROOM_NAME = 32
+#  Longest room listing sent in one notice, /rooms splits a longer one over several so each fits in a frame
+MAX_ROOMS_LISTING = 8 * 1024
+
+#  Default limits on the chat history each room keeps for users who join it later, the bytes counting each message's
+#  text and every encoding of it kept for reuse
+HISTORY_MESSAGES = 50
+HISTORY_BYTES = 96 * 1024
+
+#  Number of logged messages /last shows when no number is given
+LAST_DEFAULT = 20
+
+#  Finds every @name in a message in one pass, names are then looked up in the user dictionary. Mentioned users past
+#  MAX_MENTIONS are ignored
+MENTION_PATTERN = re.compile(br'@([^\s@]{1,%d})' % MAX_NAME_LENGTH)
+MAX_MENTIONS = 5
+#  Punctuation that may follow a mention without being part of the name
+MENTION_TRAILING = b'.,:;!?)'
+
+#  Default token bucket limits, a rate of 0 turns the limit off. Lines per second for each connection and for each
+#  source address, deliveries per second (one message to one recipient) for the server's whole output
+LINE_RATE = 0
+LINE_BURST = 20
+ADDRESS_RATE = 0
+ADDRESS_BURST = 60
+OUTPUT_RATE = 0
+OUTPUT_BURST = 50000
+
+#  Default timeouts in seconds, 0 turns a timeout off. Time allowed to register, quiet time before a framed client is
+#  pinged and quiet time after which it is dropped
+REGISTRATION_TIMEOUT = 30
+PING_INTERVAL = 60
+IDLE_TIMEOUT = 150
+
+#  Seconds per tick of the timer wheel, and the number of slots it has
+TIMER_TICK = 1.0
+TIMER_SLOTS = 256
+
+#  Connection states, small ints so each connection refers to one shared object. LOGGING_IN covers waiting for the
+#  password and for it to be checked
+NEW_USER = 0
+CHATTING = 1
+GONE = 2
+LOGGING_IN = 3
+
+#  Wrong passwords a connection may send before it is dropped
+MAX_LOGIN_FAILURES = 3
+
+#  Policies applied when a client's outbound queue goes over its limits
+DROP_OLDEST = 'drop-oldest'
+COALESCE = 'coalesce'
+DISCONNECT = 'disconnect'
+OVERFLOW_POLICIES = (DROP_OLDEST, COALESCE, DISCONNECT)
+
+###  OutboundQueue class, a push producer that holds back frames for one client while its transport is paused
+
+@implementer(IPushProducer)
+class OutboundQueue(object):
+	
+	__slots__ = ('protocol', 'max_bytes', 'max_messages', 'policy', 'frames', 'queued_bytes', 'skipped', 'paused', 'stopped')
+	
+	##  Constructor method, receives the owning protocol along with the limits and overflow policy
+	def __init__(self, protocol, max_bytes=MAX_QUEUE_BYTES, max_messages=MAX_QUEUE_MESSAGES, policy=DROP_OLDEST):
+		'''Creates an empty queue, frames only build up here once the transport asks us to pause
+		'''
+		if policy not in OVERFLOW_POLICIES:
+			raise ValueError('Unknown overflow policy %r' % (policy,))
+		self.protocol=protocol
+		self.max_bytes=max_bytes
+		self.max_messages=max_messages
+		self.policy=policy
+		#  Most clients never fall behind, so the deque is only made the first time something has to wait
+		self.frames=None
+		self.queued_bytes=0
+		self.skipped=0
+		self.paused=False
+		self.stopped=False
+	
+	##  Function to pass a frame on to the client, or hold on to it while the client is not keeping up
+	def push(self, frame):
+		'''Writes the frame straight through when the transport is accepting data, otherwise queues it
+		'''
+		if self.stopped:
+			return
+		if not self.paused and not self.frames:
+			self.protocol.transport.write(frame)
+			return
+		if self.frames is None:
+			self.frames=deque()
+		self.frames.append(frame)
+		self.queued_bytes+=len(frame)
+		if self.queued_bytes > self.max_bytes or len(self.frames) > self.max_messages:
+			self.overflow()
+	
+	##  Function to apply the overflow policy once the queue is over its limits
+	def overflow(self):
+		'''Keeps memory bounded for a slow reader by dropping, coalescing or disconnecting
+		'''
+		if self.policy == DISCONNECT:
+			self.stopped=True
+			self.clear()
+			self.protocol.transport.abortConnection()
+		elif self.policy == COALESCE:
+			#  Replace the whole backlog with a single notice of how much the client missed
+			self.skipped+=len(self.frames)
+			self.frames=deque([Message(chat_frames.NOTICE, text=b'%d messages skipped' % self.skipped).encode(self.protocol.profile)])
+			self.queued_bytes=len(self.frames[0])
+		else:
+			#  Drop from the front until we are back under both limits, always keeping the newest frame
+			while len(self.frames) > 1 and (self.queued_bytes > self.max_bytes or len(self.frames) > self.max_messages):
+				self.queued_bytes-=len(self.frames.popleft())
+	
+	##  Function to empty the queue
+	def clear(self):
+		'''Forgets every frame held for the client
+		'''
+		self.frames=None
+		self.queued_bytes=0
+	
+	##  Called by the transport when its own buffer is full. Built in IPushProducer method
+	def pauseProducing(self):
+		'''Stops writing to the transport, frames are held in the queue from now on
+		'''
+		self.paused=True
+	
+	##  Called by the transport once its buffer has drained. Built in IPushProducer method
+	def resumeProducing(self):
+		'''Hands the whole backlog to the transport in one go and goes back to writing straight through
+		'''
+		self.paused=False
+		self.skipped=0
+		if self.frames:
+			frames=list(self.frames)
+			self.clear()
+			self.protocol.transport.writeSequence(frames)
+	
+	##  Called by the transport when the connection goes away. Built in IPushProducer method
+	def stopProducing(self):
+		'''Releases anything still queued for the client
+		'''
+		self.stopped=True
+		self.clear()
+
+###  TokenBucket class, allows bursts of up to burst units and a steady rate of rate units per second
+
+class TokenBucket(object):
+	
+	__slots__ = ('rate', 'burst', 'clock', 'tokens', 'stamp')
+	
+	##  Constructor method, receives the refill rate and burst size, the bucket starts full
+	def __init__(self, rate, burst, clock=timer):
+		self.rate=float(rate)
+		self.burst=float(burst)
+		self.clock=clock
+		self.tokens=self.burst
+		self.stamp=clock()
+	
+	##  Function to spend tokens if there are enough
+	def take(self, cost=1):
+		'''Refills the bucket for the time since it was last used, then returns True and spends cost tokens if they are there
+		'''
+		now=self.clock()
+		self.tokens=min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+		self.stamp=now
+		if self.tokens < cost:
+			return False
+		self.tokens-=cost
+		return True
+
+###  LoginRefused class (inherits from Exception), raised by an Authenticator that would not check a password at all
+
+class LoginRefused(Exception):
+	pass
+
+###  TimerWheel class, one periodic call drives the deadlines of every connection
+
+class TimerWheel(object):
+	
+	##  Constructor method, receives the number of slots, one slot per tick
+	def __init__(self, slots=TIMER_SLOTS):
+		'''Creates the empty wheel, time is counted in ticks since it was made
+		'''
+		self.slots=[set() for i in range(slots)]
+		self.position=0
+		self.ticks=0
+	
+	##  Function to have an entry's timerExpired method called after a number of ticks
+	def schedule(self, entry, ticks):
+		'''Puts the entry in the slot that many ticks ahead, replacing any deadline it already had. Deadlines further off
+		than the wheel goes round are cut short, entries work out for themselves whether they are really due
+		'''
+		self.cancel(entry)
+		ticks=min(max(int(ticks), 1), len(self.slots) - 1)
+		slot=(self.position + ticks) % len(self.slots)
+		self.slots[slot].add(entry)
+		entry.timer_slot=slot
+	
+	##  Function to forget an entry's deadline
+	def cancel(self, entry):
+		'''Takes the entry off the wheel if it is on it
+		'''
+		if entry.timer_slot is not None:
+			self.slots[entry.timer_slot].discard(entry)
+			entry.timer_slot=None
+	
+	##  Function called once per tick
+	def advance(self):
+		'''Moves the wheel on one slot and calls timerExpired on everything in it
+		'''
+		self.ticks+=1
+		self.position=(self.position + 1) % len(self.slots)
+		due=self.slots[self.position]
+		self.slots[self.position]=set()
+		for entry in due:
+			entry.timer_slot=None
+			entry.timerExpired()
+
+#  Frame types whose payload is a sender and their text
+CHAT_KINDS = (chat_frames.CHAT, chat_frames.PRIVATE, chat_frames.MENTION)
+
+###  Message class, one outbound message encoded at most once for each wire format it is sent in
+
+class Message(object):
+	
+	__slots__ = ('kind', 'name', 'text', 'encoded')
+	
+	#  How each kind of message looks to a line mode (telnet) client
+	LINE_FORMATS = {
+		chat_frames.CHAT: b'>>>%(name)s : %(text)s  <<<',
+		chat_frames.PRIVATE: b'>>>%(name)s (private) : %(text)s  <<<',
+		chat_frames.MENTION: b'>>>%(name)s mentioned you : %(text)s  <<<',
+		chat_frames.JOIN: b'>>>   User %(name)s AnSeo !   <<<',
+		chat_frames.LEAVE: b' >>>   User %(name)s amach sa teach !  <<<',
+		chat_frames.NOTICE: b'>>>   %(text)s   <<<',
+		chat_frames.OK: b'OK<',
+		chat_frames.TAKEN: b'>>> Username taken! <<<',
+		chat_frames.PASSWORD: b'>>> Password : <<<',
+		chat_frames.DENIED: b'>>> Wrong username or password! <<<',
+	}
+	
+	##  Constructor method, receives the frame type along with the user name and text where the type has them
+	def __init__(self, kind, name=b'', text=b''):
+		'''Creates the message, nothing is encoded until a client with a given profile needs it
+		'''
+		self.kind=kind
+		self.name=name
+		self.text=text
+		self.encoded={}
+	
+	##  Function to get the bytes that go on the wire for a profile
+	def encode(self, profile):
+		'''Returns the complete frame for the profile, building it the first time and reusing it for every other recipient
+		'''
+		frame=self.encoded.get(profile)
+		if frame is None:
+			if profile == FRAMED:
+				frame=chat_frames.encode(self.kind, self.payload())
+			elif profile == DEFLATE:
+				#  Compressed on its own from the framed encoding, so every deflate client shares the one result
+				frame=self.encode(FRAMED)
+				if len(frame) >= DEFLATE_MIN:
+					deflated=chat_frames.deflate(frame, DEFLATE_LEVEL)
+					if len(deflated) < len(frame):
+						frame=deflated
+			else:
+				frame=self.LINE_FORMATS[self.kind] % {b'name': self.name, b'text': self.text} + ChatProtocol.delimiter
+			self.encoded[profile]=frame
+		return frame
+	
+	##  Function to give the size of the message for history limits
+	def size(self):
+		'''Returns the number of bytes the message holds, its name and text along with every encoding built so far.
+		An encoding shared between profiles is counted once
+		'''
+		encoded=dict((id(frame), len(frame)) for frame in self.encoded.values())
+		return len(self.name) + len(self.text) + sum(encoded.values())
+	
+	##  Function to build the payload of the framed encoding
+	def payload(self):
+		'''Lays out the name and text for the frame type
+		'''
+		if self.kind in CHAT_KINDS:
+			return chat_frames.encodeChat(self.name, self.text)
+		if self.kind in (chat_frames.JOIN, chat_frames.LEAVE, chat_frames.ONLINE, chat_frames.OFFLINE):
+			return self.name
+		return self.text
+	
+	##  Function to rebuild a message from its framed encoding, used for messages arriving over the worker bus
+	@classmethod
+	def fromFrame(cls, frame):
+		'''Decodes the frame and keeps it as the message's framed encoding
+		'''
+		kind, payload = frame[4:5], frame[5:]
+		if kind in CHAT_KINDS:
+			message=cls(kind, *chat_frames.decodeChat(payload))
+		elif kind in (chat_frames.JOIN, chat_frames.LEAVE, chat_frames.ONLINE, chat_frames.OFFLINE):
+			message=cls(kind, name=payload)
+		else:
+			message=cls(kind, text=payload)
+		message.encoded[FRAMED]=frame
+		return message
+
+#  Sent to a client whose line was dropped by a rate limit, encoded once and shared
+RATE_LIMITED = Message(chat_frames.NOTICE, text=b'Slow down, message not sent')
+#  Sent to a quiet framed client, which answers with a PONG frame, and the answer to a client's own PING
+PING = Message(chat_frames.PING)
+PONG = Message(chat_frames.PONG)
+
+###  Room class, the set of users that a message sent to the room is delivered to
+
+class Room(object):
+	
+	__slots__ = ('name', 'members', 'history', 'sizes', 'history_bytes', 'max_messages', 'max_bytes')
+	
+	##  Constructor method, receives the name of the room and the limits on its history
+	def __init__(self, name, max_messages=HISTORY_MESSAGES, max_bytes=HISTORY_BYTES):
+		'''Creates an empty room, rooms are made when the first user joins and dropped when the last one leaves
+		'''
+		self.name=name
+		self.members=set()
+		#  Ring buffer of the most recent chat messages, each keeps its encodings so replaying them costs no formatting
+		self.history=deque()
+		#  What each remembered message was counted as, so the total comes back down by what went into it
+		self.sizes=deque()
+		self.history_bytes=0
+		self.max_messages=max_messages
+		self.max_bytes=max_bytes
+	
+	##  Function to add a chat message to the room's history
+	def remember(self, message):
+		'''Appends the message, dropping the oldest ones once the room is over either limit
+		'''
+		if self.max_messages <= 0:
+			return
+		size=message.size()
+		self.history.append(message)
+		self.sizes.append(size)
+		self.history_bytes+=size
+		self.trim()
+	
+	##  Function to keep the history within its limits
+	def trim(self):
+		'''Drops the oldest messages while the room is over either limit
+		'''
+		while len(self.history) > self.max_messages or self.history_bytes > self.max_bytes:
+			self.history.popleft()
+			self.history_bytes-=self.sizes.popleft()
+	
+	##  Function to build the history replay for a profile
+	def replay(self, profile):
+		'''Returns every remembered message encoded for the profile as one byte string. The first replay in a profile
+		adds an encoding to each message, so the history is measured again afterwards
+		'''
+		replay=b''.join([message.encode(profile) for message in self.history])
+		self.sizes=deque([message.size() for message in self.history])
+		self.history_bytes=sum(self.sizes)
+		self.trim()
+		return replay
+
+###  Define the main Class and pass the Line receiver as a parameter
+
+class ChatProtocol(LineReceiver):
+	
+	#  Every attribute a connection ever sets, including the ones Twisted's base classes set, is given a slot. The base
+	#  classes have no __slots__ of their own, so each connection still has an instance dictionary, the slots only make
+	#  these attributes smaller and quicker to reach
+	__slots__ = ('factory', 'name', 'state', 'room', 'queue', 'profile', 'decoder', 'decoding', 'bucket', 'address',
+		'timer_slot', 'connected_at', 'seen', 'pinged', 'login', 'failures', 'transport', 'connected', 'paused', 'line_mode', '_buffer', '_busyReceiving')
+	
+	##  Initialise the Constructor passing the ChatFactory object as an argument
+	def __init__(self, factory):
+		'''Constructs the instance variables as well as the starting state of new users
+		'''
+		#  Initialise the instance variables, set our name to None and set our state to New User
+		#print('Init')
+		#  The slots shadow the class level defaults of the Twisted base classes, so they are set here
+		self.transport=None
+		self.connected=0
+		self.paused=False
+		self.line_mode=1
+		self._buffer=b''
+		self._busyReceiving=False
+		self.factory=factory
+		self.name=None
+		self.state=NEW_USER
+		self.room=None
+		self.queue=None
+		#  Line mode until the client asks for frames
+		self.profile=LINE
+		self.decoder=None
+		self.decoding=False
+		#  Token buckets for lines from this connection and from its source address, None when not limited
+		self.bucket=None
+		self.address=None
+		#  Timer wheel slot holding this connection's next deadline, the ticks it connected at and last sent anything at
+		#  and whether it has been pinged since
+		self.timer_slot=None
+		self.connected_at=0
+		self.seen=0
+		self.pinged=False
+		#  Name waiting on its password while LOGGING_IN, and how many wrong passwords the connection has sent
+		self.login=None
+		self.failures=0
+		
+	##  Reactor receives an incoming connection. Built in Line Receiver method.
+	def connectionMade(self):
+		'''Function to react to a new connection; sets the initial user state to NewUser
+		'''
+		#  Every write to this client goes through its bounded queue, registered as a streaming producer for backpressure
+		self.queue=OutboundQueue(self, self.factory.max_queue_bytes, self.factory.max_queue_messages, self.factory.overflow_policy)
+		self.transport.registerProducer(self.queue, True)
+		if self.factory.line_rate > 0:
+			self.bucket=TokenBucket(self.factory.line_rate, self.factory.line_burst)
+		self.address=getattr(self.transport.getPeer(), 'host', None)
+		self.factory.addressConnected(self.address)
+		self.factory.connections.add(self)
+		metrics=self.factory.metrics
+		if metrics is not None:
+			metrics.connections.inc()
+			metrics.connections_total.inc()
+		#  Line clients cannot answer pings, so let the kernel notice when one of them has gone
+		if hasattr(self.transport, 'setTcpKeepAlive'):
+			self.transport.setTcpKeepAlive(True)
+		#  Both engines already gather everything written to a connection during one pass of the loop into a single send,
+		#  so Nagle's algorithm has nothing left to merge and would only hold the tail of each burst back for an ACK
+		if hasattr(self.transport, 'setTcpNoDelay'):
+			self.transport.setTcpNoDelay(self.factory.nodelay)
+		self.connected_at=self.seen=self.factory.wheel.ticks
+		#  Check the 'state' of the user, if this is a new user send a welcome message otherwise the user is already registered as active,
+		#  handed over by the server process this one replaced, so only their idle deadline is needed
+		if self.state == NEW_USER:
+			if self.factory.registration_timeout:
+				self.factory.wheel.schedule(self, self.factory.registration_timeout)
+			self.sendLine(b'>>>    An Seo!    <<<') 
+		else:
+			self.checkIdle(0)
+	
+	#  If the connection breaks down, handle notification and update the user dictionary. Built in Line Receiver method.
+	#  Note, 'reason' is an exception variable returned by the protocol
+	def connectionLost(self, reason):
+		'''This function takes care of any break in connection between server and client
+		'''
+		self.state=GONE
+		self.factory.addressDisconnected(self.address)
+		self.factory.connections.discard(self)
+		if self.factory.metrics is not None:
+			self.factory.metrics.connections.dec()
+		self.factory.wheel.cancel(self)
+		#  If the user exists in the user dictionary remove the value associated with them
+		if self.name in self.factory.users:
+			del self.factory.users[self.name]
+			self.factory.dropName(self.name)
+			self.factory.releaseName(self.name)
+			self.factory.presence(chat_frames.OFFLINE, self.name)
+			#  Notify all other users of the users departure from the chat, call the broadcastMessage function
+			self.broadcastMessage(Message(chat_frames.LEAVE, self.name))
+			self.factory.leaveRoom(self)
+			
+	##  Handles incoming data. Built in Line Receiver method
+	def dataReceived(self, data):
+		'''Notes that the client is alive before passing the data on
+		'''
+		self.seen=self.factory.wheel.ticks
+		self.pinged=False
+		LineReceiver.dataReceived(self, data)
+	
+	##  Called by the timer wheel when this connection's deadline comes round
+	def timerExpired(self):
+		'''Drops a client that has not registered in time, pings a quiet framed client and drops one that stays quiet
+		'''
+		factory=self.factory
+		if self.state==NEW_USER or self.state==LOGGING_IN:
+			waited=factory.wheel.ticks - self.connected_at
+			if waited >= factory.registration_timeout:
+				self.sendNotice(b'Registration timed out')
+				self.transport.loseConnection()
+			else:
+				factory.wheel.schedule(self, factory.registration_timeout - waited)
+		elif self.state==CHATTING:
+			self.checkIdle(factory.wheel.ticks - self.seen)
+	
+	##  Function to ping or drop a registered client that has gone quiet
+	def checkIdle(self, quiet):
+		'''Only framed clients are pinged or timed out, a half open peer is aborted rather than waiting on its buffers
+		'''
+		factory=self.factory
+		if self.profile == LINE or not factory.idle_timeout:
+			return
+		if quiet >= factory.idle_timeout:
+			self.transport.abortConnection()
+			return
+		if factory.ping_interval and not self.pinged and quiet >= factory.ping_interval:
+			self.sendMessage(PING)
+			self.pinged=True
+		if factory.ping_interval and not self.pinged:
+			factory.wheel.schedule(self, min(factory.ping_interval, factory.idle_timeout) - quiet)
+		else:
+			factory.wheel.schedule(self, factory.idle_timeout - quiet)
+	
+	## Function handles the different possible incoming connections, either the user is active and currently chatting so they can be passed to handleChat function
+	## or this is a new user in which case they need to be passed to the handle_Register function for processing. Built in Line Receiver method.
+	def lineReceived(self, line):
+		'''Responsible for controlling the flow of operation, identifies if a client is currently active or if they have just joined
+		the chat and then passes them to their relevant handler functions
+		'''
+		#print('Received')
+		#If this instance is a new user pass the line to the handle_Register function, otherwise pass the line to the handle_Chat function.
+		if self.state==NEW_USER and line in (chat_frames.HELLO, chat_frames.HELLO_DEFLATE) and self.profile == LINE:
+			self.startFraming(line == chat_frames.HELLO_DEFLATE and self.factory.deflate)
+		#  Over a limit, the line is dropped before anything is formatted, fanned out or hashed
+		elif not self.factory.allowLine(self):
+			self.rateLimited()
+		elif self.state==NEW_USER:
+			#print('Registering')
+			self.handle_Register(line)
+		elif self.state==LOGGING_IN:
+			self.authenticate(self.login, line)
+		elif line.startswith(b'/'):
+			self.handle_Command(line)
+		else:
+			#print('Chatting')
+			self.handle_Chat(line)
+		
+	##  Function to register new users
+	def handle_Register(self, name):
+		'''This function is responsible registering new users. Clients may send their name without waiting for the
+		greeting, in the same packet as their HELLO line, so it can arrive before anything has been written back
+		'''
+		#print('Handle reg')
+		#  A framed client may send its password along with its name, after a NUL byte
+		name, sent, password = name.partition(b'\x00')
+		#  If the name already exists in the user dictionary, or cannot be used at all, ask again. 
+		if (not name or len(name) > MAX_NAME_LENGTH or INVALID_NAME.search(name) or name in self.factory.users
+				or name in self.factory.remote_users):
+			self.sendMessage(Message(chat_frames.TAKEN))
+			return
+		if self.factory.auth is not None:
+			if sent:
+				self.authenticate(name, password)
+			else:
+				#  Ask for the password on its own line or frame
+				self.login=name
+				self.state=LOGGING_IN
+				self.sendMessage(Message(chat_frames.PASSWORD))
+			return
+		self.claim(name)
+	
+	##  Function to check a user's password before their name is claimed
+	def authenticate(self, name, password):
+		'''Hashing happens off the event loop, so further lines are held until the answer comes back
+		'''
+		self.login=name
+		self.state=LOGGING_IN
+		self.pauseProducing()
+		d=self.factory.auth.verify(name, password, self.address)
+		d.addCallback(self.authenticated, name)
+		d.addErrback(self.loginRefused)
+	
+	##  Function to turn a client away when its password could not be checked
+	def loginRefused(self, failure):
+		'''Tells the client why when the Authenticator refused to check, then drops the connection
+		'''
+		self.login=None
+		if failure.check(LoginRefused) and self.state!=GONE:
+			self.sendMessage(Message(chat_frames.NOTICE, text=str(failure.value).encode('utf-8')))
+			if self.factory.metrics is not None:
+				self.factory.metrics.rate_limited.inc()
+		self.transport.loseConnection()
+	
+	##  Function to carry on with registration once the password has been checked
+	def authenticated(self, valid, name):
+		'''Claims the name if the password was right, otherwise asks for the name again and drops the connection after
+		too many wrong passwords
+		'''
+		self.login=None
+		if self.state==GONE:
+			return
+		if valid:
+			self.claim(name)
+			return
+		self.state=NEW_USER
+		self.failures+=1
+		if self.factory.metrics is not None:
+			self.factory.metrics.login_failures.inc()
+		self.sendMessage(Message(chat_frames.DENIED))
+		if self.failures >= MAX_LOGIN_FAILURES:
+			self.transport.loseConnection()
+			return
+		self.resumeProducing()
+	
+	##  Function to claim a user name for this client
+	def claim(self, name):
+		'''Asks the factory for the name, which may mean a round trip to the other workers
+		'''
+		#  Hold any further lines from this client until the name is claimed
+		self.pauseProducing()
+		d=self.factory.claimName(name)
+		d.addCallback(self.nameClaimed, name)
+		d.addErrback(lambda failure: self.transport.loseConnection())
+	
+	##  Function to finish registration once the claim on the name has been answered
+	def nameClaimed(self, claimed, name):
+		'''Completes the registration if the name was ours to take, otherwise asks again
+		'''
+		#  The client may have gone while we waited, give the name straight back
+		if self.state==GONE:
+			if claimed:
+				self.factory.releaseName(name)
+			return
+		if not claimed:
+			self.state=NEW_USER
+			self.sendMessage(Message(chat_frames.TAKEN))
+			self.resumeProducing()
+			return
+		self.sendMessage(Message(chat_frames.OK))
+		#  Assign the instance variable to the user name received
+		name=self.factory.internName(name)
+		self.name=name
+		#  Set the current name in the dictionary to represent this instance and set the state to one of a registered user
+		self.factory.users[name]=self
+		if self.factory.metrics is not None:
+			self.factory.metrics.registrations.inc()
+		self.state =CHATTING
+		#  Swap the registration deadline for the idle one
+		self.factory.wheel.cancel(self)
+		self.checkIdle(self.factory.wheel.ticks - self.seen)
+		#  Framed clients track who is online themselves, from one snapshot now and a delta for every change after it
+		self.factory.presence(chat_frames.ONLINE, name, self)
+		if self.profile != LINE:
+			for message in self.factory.roster():
+				self.sendMessage(message)
+		#  Everyone starts out in the lobby, catch the client up on it and notify the other clients in it of the new client
+		self.factory.joinRoom(self, DEFAULT_ROOM)
+		self.replayHistory()
+		self.broadcastMessage(Message(chat_frames.JOIN, name))
+		#  Carry on with any lines the client sent after its name
+		self.resumeProducing()
+	
+	##  Function to handle the incoming messages	
+	def handle_Chat(self, message):
+		'''This function reacts to and also handles the received messages from the client
+		'''
+		#  Check the server's output budget against the room size before building anything
+		if not self.factory.allowOutput(len(self.room.members) - 1):
+			self.rateLimited()
+			return
+		if self.factory.metrics is not None:
+			self.factory.metrics.messages_in.inc()
+		#  Wrap the text up with the sender, once done pass the message to the broadcastMessage function
+		message=Message(chat_frames.CHAT, self.name, message)
+		#  Keep a durable copy, this only queues the record for the log's writer thread
+		if self.factory.log is not None:
+			self.factory.log.append(self.room.name, message.encode(FRAMED))
+		self.broadcastMessage(message)
+		#  Most messages mention nobody, so only look for names when there is an @ at all
+		if b'@' in message.text:
+			self.notifyMentions(message.text)
+	
+	##  Function to pass a message on to the users it mentions
+	def notifyMentions(self, text):
+		'''Sends a MENTION copy, shared between them, to each mentioned user outside this room
+		'''
+		factory=self.factory
+		mention=None
+		found=set()
+		for name in MENTION_PATTERN.findall(text):
+			if name not in factory.names:
+				name=name.rstrip(MENTION_TRAILING)
+				if name not in factory.names:
+					continue
+			if name == self.name or name in found:
+				continue
+			found.add(name)
+			if mention is None:
+				mention=Message(chat_frames.MENTION, self.name, text)
+			factory.deliver(name, mention, self.room.name)
+			if len(found) >= MAX_MENTIONS:
+				return
+	
+	##  Function to send one user a private message
+	def handle_Msg(self, argument):
+		'''Looks the user up by name and sends the text to them alone
+		'''
+		name, _, text = argument.partition(b' ')
+		text=text.strip()
+		if not name or not text:
+			self.sendNotice(b'Usage : /msg <user> <text>')
+			return
+		if not self.factory.allowOutput(1):
+			self.rateLimited()
+			return
+		if not self.factory.deliver(name, Message(chat_frames.PRIVATE, self.name, text)):
+			self.sendNotice(b'No user named %s'%name)
+	
+	##  Function to tell the user a line of theirs was dropped by a rate limit
+	def rateLimited(self):
+		'''Sends the shared notice and counts the dropped line
+		'''
+		self.sendMessage(RATE_LIMITED)
+		if self.factory.metrics is not None:
+			self.factory.metrics.rate_limited.inc()
+	
+	##  Function to handle the commands a registered user can send, /join, /part, /rooms, /msg, /last and /since
+	def handle_Command(self, line):
+		'''Splits the command from its argument and passes it on to the matching handler
+		'''
+		command, _, argument = line[1:].partition(b' ')
+		handler = {b'join': self.handle_Join, b'part': self.handle_Part, b'rooms': self.handle_Rooms,
+			b'msg': self.handle_Msg, b'last': self.handle_Last, b'since': self.handle_Since}.get(command.lower())
+		if handler is None:
+			self.sendNotice(b'Unknown command /%s'%command)
+			return
+		handler(argument.strip())
+	
+	##  Function to move the user into another room, creating it if nobody is in it yet
+	def handle_Join(self, name):
+		'''Leaves the current room and joins the named one
+		'''
+		name=name.lstrip(b'#')
+		if not name or len(name) > MAX_ROOM_NAME or b' ' in name or INVALID_NAME.search(name):
+			self.sendNotice(b'Usage : /join <room>')
+			return
+		if name == self.room.name:
+			self.sendNotice(b'Already in %s'%name)
+			return
+		self.broadcastMessage(Message(chat_frames.NOTICE, text=b'User %s has left %s'%(self.name, self.room.name)))
+		self.factory.leaveRoom(self)
+		self.factory.joinRoom(self, name)
+		self.broadcastMessage(Message(chat_frames.NOTICE, text=b'User %s has joined %s'%(self.name, name)))
+		self.sendNotice(b'Now in room %s'%name)
+		self.replayHistory()
+	
+	##  Function to leave the current room and go back to the lobby
+	def handle_Part(self, argument):
+		'''Returns the user to the default room
+		'''
+		if self.room.name == DEFAULT_ROOM:
+			self.sendNotice(b'Already in %s'%DEFAULT_ROOM)
+			return
+		self.handle_Join(DEFAULT_ROOM)
+	
+	##  Function to list the rooms in use
+	def handle_Rooms(self, argument):
+		'''Sends the user a line naming every room and how many users are in it, or several lines when there are
+		too many rooms for one
+		'''
+		rooms = sorted(self.factory.rooms.values(), key=lambda room: room.name)
+		listing = []
+		size = 0
+		for room in rooms:
+			entry = b'%s (%d)'%(room.name, len(room.members))
+			if listing and size + 2 + len(entry) > MAX_ROOMS_LISTING:
+				self.sendNotice(b'Rooms : %s'%b', '.join(listing))
+				listing = []
+				size = 0
+			size += len(entry) + (2 if listing else 0)
+			listing.append(entry)
+		self.sendNotice(b'Rooms : %s'%b', '.join(listing))
+	
+	##  Function to show the user the most recent logged messages of their room
+	def handle_Last(self, argument):
+		'''Reads the last N records of the user's room from the message log, N defaulting to LAST_DEFAULT
+		'''
+		if self.factory.log is None:
+			self.sendNotice(b'The message log is not enabled')
+			return
+		try:
+			count=int(argument) if argument else LAST_DEFAULT
+		except ValueError:
+			self.sendNotice(b'Usage : /last [count]')
+			return
+		self.sendLogged(self.factory.log.last(count, self.room.name))
+	
+	##  Function to show the user the logged messages of their room from an offset onwards
+	def handle_Since(self, argument):
+		'''Reads the message log from the offset given
+		'''
+		if self.factory.log is None:
+			self.sendNotice(b'The message log is not enabled')
+			return
+		try:
+			offset=int(argument)
+		except ValueError:
+			self.sendNotice(b'Usage : /since <offset>')
+			return
+		self.sendLogged(self.factory.log.read(max(offset, 0)))
+	
+	##  Function to send the user records read from the message log
+	def sendLogged(self, records):
+		'''Sends the records for the user's room in one write, followed by the offset to carry on from
+		'''
+		room=self.room.name
+		if self.profile != LINE:
+			#  The log holds the framed encoding, so framed clients get the stored bytes as they are
+			frames=[frame for offset, stamp, name, frame in records if name == room]
+		else:
+			frames=[Message.fromFrame(frame).encode(self.profile) for offset, stamp, name, frame in records if name == room]
+		if frames:
+			self.sendBlock(b''.join(frames))
+		following=records[-1][0] + 1 if records else self.factory.log.next_offset
+		self.sendNotice(b'Log offset %d'%following)
+	
+	##  Function to handle the broadcasting of messages between clients
+	def broadcastMessage(self, message):
+		'''Sends the message to every other client in this user's room, on this worker and on any others
+		'''
+		self.factory.broadcast(self.room.name, message, self)
+		#  Other workers fan the message out to their own clients in the room
+		if self.factory.bus is not None:
+			self.factory.bus.broadcast(self.room.name, message.encode(FRAMED))
+	
+	##  Sends a single raw line to this client. Overrides the Line Receiver method so it goes through the outbound queue
+	def sendLine(self, line):
+		'''Adds the delimiter and passes the line to the outbound queue
+		'''
+		self.sendFrame(line + self.delimiter)
+	
+	##  Function to send a message to this client alone
+	def sendMessage(self, message):
+		'''Encodes the message in this client's profile and queues it
+		'''
+		self.sendFrame(message.encode(self.profile))
+	
+	##  Function to send this client a notice from the server
+	def sendNotice(self, text):
+		'''Wraps the text up as a notice and sends it to this client
+		'''
+		self.sendMessage(Message(chat_frames.NOTICE, text=text))
+	
+	##  Function to catch this client up on what was said in its room before it arrived
+	def replayHistory(self):
+		'''Sends the room's whole history as a single write rather than one per message
+		'''
+		if self.room.history:
+			self.sendBlock(self.room.replay(FRAMED if self.profile == DEFLATE else self.profile))
+	
+	##  Function to send this client a run of frames meant for it alone
+	def sendBlock(self, frames):
+		'''Sends the frames as they are, or for a deflate client compressed together, which does better than
+		compressing them one at a time. A long run goes out as several DEFLATED frames within the frame limits
+		'''
+		if self.profile == DEFLATE and len(frames) >= DEFLATE_MIN:
+			frames=chat_frames.deflateBlock(frames, DEFLATE_LEVEL)
+		self.sendFrame(frames)
+	
+	##  Function to send an already encoded frame to this client
+	def sendFrame(self, frame):
+		'''Queues a complete frame for this client, subject to the queue limits
+		'''
+		self.queue.push(frame)
+	
+	##  Function to switch the connection over to length prefixed frames
+	def startFraming(self, deflate=False):
+		'''Everything after the client's HELLO line is read and written as frames, compressed where it helps if deflate is set
+		'''
+		self.profile=DEFLATE if deflate else FRAMED
+		#  Clients never send compressed frames, so they are not expanded
+		self.decoder=chat_frames.FrameDecoder(max_length=MAX_CLIENT_FRAME, inflate=False)
+		self.setRawMode()
+	
+	##  Handles incoming data once the connection is framed. Built in Line Receiver method
+	def rawDataReceived(self, data):
+		'''Decodes frames and passes chat frames through the same flow as lines, one at a time so pausing still works
+		'''
+		self.decoder.feed(data)
+		#  Already working through the buffer further up the stack, that loop will pick up the new data
+		if self.decoding:
+			return
+		self.decoding=True
+		try:
+			while not self.paused:
+				frame=self.decoder.next()
+				if frame is None:
+					return
+				kind, payload = frame
+				if kind == chat_frames.CHAT:
+					self.lineReceived(payload)
+				elif kind == chat_frames.PING:
+					self.sendMessage(PONG)
+		except chat_frames.FrameError:
+			self.transport.loseConnection()
+		finally:
+			self.decoding=False
+	
+	##  Picks up reading again after registration. Overrides the Line Receiver method
+	def resumeProducing(self):
+		'''Also drains any frames that were already decoded into the buffer while paused. While the server is
+		handing its connections over nothing is read, the handoff resumes the connection if the takeover fails
+		'''
+		if self.factory.suspended:
+			self.paused=False
+			return
+		LineReceiver.resumeProducing(self)
+		if self.decoder is not None:
+			self.rawDataReceived(b'')
+
+
+###  ChatFactory class (inherits from Factory), used to create, store and manage the multiple connections to the server		
+
+class ChatFactory(Factory):
+	
+	##  Constructor method, creates the user dictionary and then builds a TCP object factory, location of shared state variables.
+	def __init__(self, max_queue_bytes=MAX_QUEUE_BYTES, max_queue_messages=MAX_QUEUE_MESSAGES, overflow_policy=DROP_OLDEST,
+			history_messages=HISTORY_MESSAGES, history_bytes=HISTORY_BYTES, log=None, line_rate=LINE_RATE, line_burst=LINE_BURST,
+			address_rate=ADDRESS_RATE, address_burst=ADDRESS_BURST, output_rate=OUTPUT_RATE, output_burst=OUTPUT_BURST,
+			registration_timeout=REGISTRATION_TIMEOUT, ping_interval=PING_INTERVAL, idle_timeout=IDLE_TIMEOUT, metrics=False,
+			deflate=True, nodelay=True, auth=None):
+		if overflow_policy not in OVERFLOW_POLICIES:
+			raise ValueError('Unknown overflow policy %r' % (overflow_policy,))
+		self.users={}
+		#  Every open connection, registered or not, and whether they are all suspended for a handoff
+		self.connections=set()
+		self.suspended=False
+		#  Rooms in use on this process, keyed by name
+		self.rooms={}
+		#  Names held by clients of other worker processes, kept up to date over the worker bus
+		self.remote_users=set()
+		#  Interned user names, one bytes object per name online here or on another worker shared by every reference to it
+		self.names={}
+		self.bus=None
+		self.bus_attached=defer.Deferred()
+		#  Per client outbound queue limits and what to do with a client that goes over them
+		self.max_queue_bytes=max_queue_bytes
+		self.max_queue_messages=max_queue_messages
+		self.overflow_policy=overflow_policy
+		#  Limits on each room's history
+		self.history_messages=history_messages
+		self.history_bytes=history_bytes
+		#  Durable message log, None when it is turned off
+		self.log=log
+		#  Rate limits, per connection buckets live on the protocols, per address ones here for as long as the address is connected
+		self.line_rate=line_rate
+		self.line_burst=line_burst
+		self.address_rate=address_rate
+		self.address_burst=address_burst
+		self.address_buckets={}
+		self.address_connections={}
+		self.output=TokenBucket(output_rate, output_burst) if output_rate > 0 else None
+		#  Timeouts in ticks of the one timer wheel shared by every connection
+		self.registration_timeout=int(registration_timeout / TIMER_TICK)
+		self.ping_interval=int(ping_interval / TIMER_TICK)
+		self.idle_timeout=int(idle_timeout / TIMER_TICK)
+		#  Turned once a tick by whichever engine runs the factory
+		self.wheel=TimerWheel()
+		#  Metrics registry, None when metrics are turned off so the hot paths only pay for an identity check
+		self.metrics=ChatMetrics(self) if metrics else None
+		#  Whether clients asking for compression get it, those that are refused are sent plain frames
+		self.deflate=deflate
+		#  Whether client sockets have Nagle's algorithm turned off, see ChatProtocol.connectionMade
+		self.nodelay=nodelay
+		#  Authenticator checking passwords on registration, None when any free name may be used
+		self.auth=auth
+		print('***** Welcome to the "An Seo" Server *****')
+		print('*****    Server is listening....     *****')
+	
+	##  Returns a ChatProtocol object for each instance. Built in Factory method
+	def buildProtocol(self, addr):
+		'''This function returns an instance of ChatProtocol for each client received
+		'''
+		return ChatProtocol(self)
+	
+	##  Function to count a new connection from an address
+	def addressConnected(self, address):
+		'''Creates the address's token bucket with its first connection
+		'''
+		if self.address_rate <= 0 or address is None:
+			return
+		count=self.address_connections.get(address, 0)
+		if not count:
+			self.address_buckets[address]=TokenBucket(self.address_rate, self.address_burst)
+		self.address_connections[address]=count + 1
+	
+	##  Function to count a connection from an address going away
+	def addressDisconnected(self, address):
+		'''Drops the address's token bucket with its last connection so the table only holds connected addresses
+		'''
+		count=self.address_connections.get(address)
+		if count is None:
+			return
+		if count > 1:
+			self.address_connections[address]=count - 1
+		else:
+			del self.address_connections[address]
+			del self.address_buckets[address]
+	
+	##  Function to check a line from a client against its connection's and its address's limits
+	def allowLine(self, protocol):
+		'''Returns True if the line may be handled, spending a token from each bucket that applies
+		'''
+		if protocol.bucket is not None and not protocol.bucket.take():
+			return False
+		bucket=self.address_buckets.get(protocol.address)
+		return bucket is None or bucket.take()
+	
+	##  Function to check a fan out against the server's output budget
+	def allowOutput(self, deliveries):
+		'''Returns True if the server can afford to deliver a message to this many recipients. A room bigger than the
+		burst is charged the whole burst, so its messages still go out once the bucket has filled
+		'''
+		return self.output is None or self.output.take(min(deliveries, self.output.burst))
+	
+	##  Function to fan a message out to the members of a room connected to this process
+	def broadcast(self, room, message, exclude=None):
+		'''Hands every local member of the room the message, encoded once per profile and shared between them
+		'''
+		#  Nobody here is in the room, so there is nothing to encode, keep or send
+		room=self.rooms.get(room)
+		if room is None:
+			return
+		metrics=self.metrics
+		if metrics is not None:
+			started=timer()
+		#  For each protocol in the room, skip the sender and write the shared frame for its profile
+		for protocol in room.members:
+			if protocol is not exclude:
+				protocol.sendFrame(message.encode(protocol.profile))
+		if metrics is not None:
+			recipients=len(room.members) - (exclude in room.members)
+			metrics.broadcast_seconds.observe(timer() - started)
+			metrics.fanout.observe(recipients)
+			metrics.messages_out.inc(recipients)
+		#  Remembered once fanned out, so the history counts the encodings the members needed
+		if message.kind == chat_frames.CHAT:
+			room.remember(message)
+	
+	##  Function to tell framed clients a user has come online or gone offline
+	def presence(self, kind, name, exclude=None):
+		'''Sends every framed client on this process one shared ONLINE or OFFLINE frame for the name
+		'''
+		frame=Message(kind, name).encode(FRAMED)
+		for protocol in self.users.values():
+			if protocol.profile != LINE and protocol is not exclude:
+				protocol.sendFrame(frame)
+	
+	##  Function to build the snapshot of everyone online
+	def roster(self):
+		'''Returns the ROSTER messages naming every user on this process and on the other workers, split so that no
+		frame goes over the frame size limit
+		'''
+		names=list(self.users)
+		names.extend(self.remote_users)
+		return [Message(chat_frames.ROSTER, text=payload) for payload in chat_frames.encodeRoster(names)]
+	
+	##  Function to get the one shared copy of a user name
+	def internName(self, name):
+		'''Returns the copy of the name already in the table, adding this one if there is none
+		'''
+		return self.names.setdefault(name, name)
+	
+	##  Function to drop a user name from the table once nobody online has it
+	def dropName(self, name):
+		'''Forgets the name's interned copy
+		'''
+		self.names.pop(name, None)
+	
+	##  Function to record a user registered on another worker
+	def remoteOnline(self, name):
+		'''Adds the name to the remote users and passes the change on to framed clients
+		'''
+		if name not in self.remote_users:
+			name=self.internName(name)
+			self.remote_users.add(name)
+			self.presence(chat_frames.ONLINE, name)
+	
+	##  Function to record a user of another worker leaving
+	def remoteOffline(self, name):
+		'''Drops the name from the remote users and passes the change on to framed clients
+		'''
+		if name in self.remote_users:
+			self.dropName(name)
+			self.remote_users.discard(name)
+			self.presence(chat_frames.OFFLINE, name)
+	
+	##  Function to send a message to one user, wherever they are connected
+	def deliver(self, name, message, room=b''):
+		'''Finds the user by name and sends them the message, through the bus if they are on another worker. Given a
+		room, users in that room are skipped since they have already had the message. Returns False for an unknown user
+		'''
+		protocol=self.users.get(name)
+		if protocol is not None:
+			if not room or protocol.room is None or protocol.room.name != room:
+				protocol.sendMessage(message)
+			if self.metrics is not None:
+				self.metrics.direct.inc()
+			return True
+		if name in self.remote_users and self.bus is not None:
+			self.bus.direct(name, room, message.encode(FRAMED))
+			return True
+		return False
+	
+	##  Function to pass on a message another worker sent to one of our users
+	def receiveDirect(self, name, room, frame):
+		'''Rebuilds the message from its framed encoding and sends it to the user if they are still here
+		'''
+		if name in self.users:
+			self.deliver(name, Message.fromFrame(frame), room)
+	
+	##  Function to fan out a message forwarded by another worker
+	def receiveBroadcast(self, room, frame):
+		'''Rebuilds the message from its framed encoding and sends it to the local members of the room
+		'''
+		message=Message.fromFrame(frame)
+		#  Share the sender's name with every other reference to it rather than keeping a copy per message in history
+		message.name=self.names.get(message.name, message.name)
+		self.broadcast(room, message)
+	
+	##  Function to add a user to a room
+	def joinRoom(self, protocol, name):
+		'''Puts the user in the named room, creating the room if it does not exist yet
+		'''
+		room=self.rooms.get(name)
+		if room is None:
+			room=self.rooms[name]=Room(name, self.history_messages, self.history_bytes)
+		room.members.add(protocol)
+		protocol.room=room
+		return room
+	
+	##  Function to take a user out of their room
+	def leaveRoom(self, protocol):
+		'''Removes the user from their room, dropping the room once it is empty
+		'''
+		room=protocol.room
+		if room is None:
+			return
+		room.members.discard(protocol)
+		protocol.room=None
+		if not room.members:
+			del self.rooms[room.name]
+	
+	##  Function to claim a user name, cluster wide when running as a worker
+	def claimName(self, name):
+		'''Returns a Deferred that fires with True if the name is now ours and False if it is taken
+		'''
+		if self.bus is None:
+			return defer.succeed(name not in self.users)
+		return self.bus.claim(name)
+	
+	##  Function to give up a user name once its client has gone
+	def releaseName(self, name):
+		'''Frees the name on the other workers, nothing to do when running alone
+		'''
+		if self.bus is not None:
+			self.bus.release(name)
+	
+	##  Called by the worker bus once it has connected to the master
+	def attachBus(self, bus):
+		'''Routes registrations and broadcasts through the bus from now on
+		'''
+		self.bus=bus
+		self.bus_attached.callback(bus)
+	
+	##  Called by the worker bus when the master goes away
+	def detachBus(self, bus):
+		'''Forgets the bus and everything it told us about the other workers
+		'''
+		self.bus=None
+		for name in list(self.remote_users):
+			self.remoteOffline(name)
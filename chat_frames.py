@@ -0,0 +1,238 @@
+#!/usr/bin/python
+
+#  Compact framing shared by the server and the client. Plain Python so it runs under both CPython and Jython.
+#  A client switches its connection to framed mode by sending HELLO as its very first line. The server's greeting
+#  is still a single line, everything after it in both directions is made of frames laid out as
+#
+#      4 byte big endian length | 1 byte type | payload
+#
+#  where the length counts the type byte and the payload.
+
+import struct
+import zlib
+
+#  First line a client sends to ask for framed mode, the NUL byte means no telnet user can type it by accident
+HELLO = b'\x00ANSEO FRAMED 1'
+#  Sent instead of HELLO to also have the server compress what it sends
+HELLO_DEFLATE = b'\x00ANSEO FRAMED 1 DEFLATE'
+
+#  Frame types
+CHAT = b'C'
+JOIN = b'J'
+LEAVE = b'L'
+NOTICE = b'N'
+OK = b'K'
+TAKEN = b'T'
+#  Sent when the server checks passwords and the name frame did not carry one, and when a name and password are refused
+PASSWORD = b'W'
+DENIED = b'X'
+#  Chat sent to one user alone with /msg, and a copy of a room message sent to a user it mentions who is not in the room,
+#  both laid out like CHAT
+PRIVATE = b'D'
+MENTION = b'M'
+#  Presence, the server sends a framed client every name online once it registers and then each change to that set
+ROSTER = b'R'
+ONLINE = b'O'
+OFFLINE = b'F'
+#  Keepalive, either end pings when it has heard nothing for a while and the other answers with a pong
+PING = b'P'
+PONG = b'Q'
+#  A run of complete frames compressed together, only ever sent to a client that asked for it with HELLO_DEFLATE
+DEFLATED = b'Z'
+
+#  Largest frame either side will accept
+MAX_FRAME_LENGTH = 64 * 1024
+#  Largest run of frames a DEFLATED frame may expand to
+MAX_INFLATED_LENGTH = 1024 * 1024
+
+_header = struct.Struct('!I')
+
+###  FrameError class, raised when the other side sends something that is not a valid frame
+
+class FrameError(ValueError):
+	pass
+
+##  Function to build a complete frame
+def encode(kind, payload=b''):
+	'''Returns the length prefixed frame for the type byte and payload
+	'''
+	return _header.pack(len(payload) + 1) + kind + payload
+
+##  Function to build the payload of a chat frame sent by the server
+def encodeChat(sender, text):
+	'''Prefixes the text with the sender's name, itself prefixed by its length in one byte
+	'''
+	return struct.pack('!B', len(sender)) + sender + text
+
+##  Function to compress one or more complete frames into a single DEFLATED frame
+def deflate(frames, level=6):
+	'''Compresses the frames on their own, with no state carried over from earlier frames, so the result can be
+	sent to any number of clients
+	'''
+	return encode(DEFLATED, zlib.compress(frames, level))
+
+##  Function to compress a run of complete frames of any length
+def deflateBlock(frames, level=6):
+	'''Splits the run at frame boundaries into DEFLATED frames that each expand to at most MAX_INFLATED_LENGTH and
+	compress to a payload that fits in a frame. A lone frame that does not compress that small is kept as it is
+	'''
+	ends=[]
+	offset=0
+	while offset < len(frames):
+		offset+=4 + _header.unpack_from(frames, offset)[0]
+		ends.append(offset)
+	#  Greedily take as many frames as expand within the limit, then compress them, halving the run while its
+	#  compressed form is still too big for one frame
+	runs=[]
+	first=0
+	for last in range(1, len(ends) + 1):
+		start=ends[first - 1] if first else 0
+		if ends[last - 1] - start > MAX_INFLATED_LENGTH and last - 1 > first:
+			runs.append((first, last - 1))
+			first=last - 1
+	if ends:
+		runs.append((first, len(ends)))
+	blocks=[]
+	while runs:
+		first, last = runs.pop(0)
+		start=ends[first - 1] if first else 0
+		run=frames[start:ends[last - 1]]
+		compressed=zlib.compress(run, level)
+		if len(compressed) < MAX_FRAME_LENGTH:
+			blocks.append(encode(DEFLATED, compressed))
+		elif last - first == 1:
+			blocks.append(run)
+		else:
+			middle=(first + last) // 2
+			runs[:0]=[(first, middle), (middle, last)]
+	return b''.join(blocks)
+
+##  Function to build the payloads of the roster frames
+def encodeRoster(names, max_payload=MAX_FRAME_LENGTH - 1):
+	'''Joins the names with newlines, which the server refuses in a name along with every other control byte. Returns
+	one or more payloads, each small enough for a frame, which together name everyone
+	'''
+	payloads=[]
+	chunk=[]
+	size=0
+	for name in names:
+		if chunk and size + 1 + len(name) > max_payload:
+			payloads.append(b'\n'.join(chunk))
+			chunk=[]
+			size=0
+		size+=len(name) + (1 if chunk else 0)
+		chunk.append(name)
+	payloads.append(b'\n'.join(chunk))
+	return payloads
+
+##  Function to split the payload of a roster frame
+def decodeRoster(payload):
+	'''Returns the list of names held in a roster frame's payload
+	'''
+	if not payload:
+		return []
+	return payload.split(b'\n')
+
+##  Function to split the payload of a chat frame sent by the server
+def decodeChat(payload):
+	'''Returns the sender and text held in a chat frame's payload
+	'''
+	size=struct.unpack('!B', payload[:1])[0]
+	return payload[1:size + 1], payload[size + 1:]
+
+###  FrameDecoder class, turns the bytes read off a connection back into frames
+
+class FrameDecoder(object):
+
+	##  Constructor method, set greeting when the stream starts with the server's greeting line and clear inflate to
+	##  leave DEFLATED frames compressed
+	def __init__(self, greeting=False, max_length=MAX_FRAME_LENGTH, inflate=True):
+		'''Creates an empty decoder
+		'''
+		self.greeting=greeting
+		self.max_length=max_length
+		self.inflate_frames=inflate
+		self.buffer=b''
+		self.offset=0
+		#  Frames taken out of a DEFLATED frame and not returned yet
+		self.inflated=[]
+
+	##  Function to add newly received bytes
+	def feed(self, data):
+		'''Appends the data, dropping whatever has already been decoded first
+		'''
+		if self.offset:
+			self.buffer=self.buffer[self.offset:]
+			self.offset=0
+		self.buffer+=data
+
+	##  Function to give back the bytes fed in that have not been decoded yet
+	def remaining(self):
+		return self.buffer[self.offset:]
+
+	##  Function to take the next complete frame out of the buffer
+	def next(self):
+		'''Returns the next (type, payload) pair, or None if the whole frame has not arrived yet. The frames inside a
+		DEFLATED frame are returned one by one as if they had been sent as they are
+		'''
+		if self.inflated:
+			return self.inflated.pop(0)
+		if self.greeting:
+			end=self.buffer.find(b'\r\n', self.offset)
+			if end < 0:
+				return None
+			line=self.buffer[self.offset:end]
+			self.offset=end + 2
+			self.greeting=False
+			return NOTICE, line
+		if len(self.buffer) - self.offset < 4:
+			return None
+		length=_header.unpack_from(self.buffer, self.offset)[0]
+		if length < 1 or length > self.max_length:
+			raise FrameError('Bad frame length %d' % length)
+		start=self.offset + 4
+		end=start + length
+		if len(self.buffer) < end:
+			return None
+		self.offset=end
+		kind=self.buffer[start:start + 1]
+		if kind == DEFLATED and self.inflate_frames:
+			self.inflated=self.inflate(self.buffer[start + 1:end])
+			return self.next()
+		return kind, self.buffer[start + 1:end]
+	
+	##  Function to expand the payload of a DEFLATED frame
+	def inflate(self, payload):
+		'''Returns the list of frames the payload decompresses to, refusing anything that expands too far
+		'''
+		try:
+			inflater=zlib.decompressobj()
+			frames=inflater.decompress(payload, MAX_INFLATED_LENGTH)
+		except zlib.error:
+			raise FrameError('Bad compressed frame')
+		if inflater.unconsumed_tail:
+			raise FrameError('Compressed frame expands past %d bytes' % MAX_INFLATED_LENGTH)
+		decoder=FrameDecoder(max_length=self.max_length, inflate=False)
+		decoder.feed(frames)
+		inflated=[]
+		frame=decoder.next()
+		while frame is not None:
+			if frame[0] == DEFLATED:
+				raise FrameError('Nested compressed frame')
+			inflated.append(frame)
+			frame=decoder.next()
+		if decoder.offset != len(decoder.buffer):
+			raise FrameError('Compressed frame ends part way through a frame')
+		return inflated
+
+	##  Function to decode everything that can be decoded from the data
+	def frames(self, data):
+		'''Feeds the data and returns the list of every complete frame now available
+		'''
+		self.feed(data)
+		frames=[]
+		frame=self.next()
+		while frame is not None:
+			frames.append(frame)
+			frame=self.next()
+		return frames
@@ -0,0 +1,250 @@
+#!/usr/bin/python
+
+#  Zero downtime restarts. A server started with --handoff-socket PATH listens on that UNIX socket, and a new server
+#  started with the same path and --takeover connects to it and takes over. The old process stops reading from its
+#  clients and stops accepting. It then passes the listening socket and every registered client's socket across with
+#  SCM_RIGHTS, followed by a description of each user, and exits once the new process has acknowledged it all. The
+#  new process adopts the sockets and puts each user back in their room without a word on the wire, so clients carry
+#  on as if nothing had happened. Clients still registering are not handed over, they are closed with the old process,
+#  and nothing is read from them either once the handoff has started so they cannot join halfway through it.
+#
+#  The description is one message on the handoff socket, laid out as
+#
+#      4 byte big endian length | JSON
+#
+#  with bytes values base64 encoded. The JSON describes the file descriptors in the order they were sent, the
+#  listening socket first.
+
+import base64
+import json
+import os
+import socket
+import struct
+
+from twisted.internet.protocol import Factory, Protocol
+
+import chat_frames
+from chat_core import CHATTING, FRAMED, GONE, LINE, MAX_CLIENT_FRAME, Message
+
+#  Acknowledgement the new process sends once it has everything
+ACK = b'K'
+
+#  Most file descriptors the new process expects alongside each read
+MAX_FDS_PER_READ = 64
+
+##  Functions to carry bytes in JSON
+def pack(data):
+	return base64.b64encode(bytes(data)).decode('ascii')
+
+def unpack(text):
+	return base64.b64decode(text.encode('ascii'))
+
+##  Function to describe one user for the new process
+def snapshot(protocol):
+	'''Returns the user's name, room and wire format along with what they sent that has not been handled yet and what
+	they have been sent that has not reached them yet, taken from the protocol, its queue and the Twisted transport
+	'''
+	transport=protocol.transport
+	received=protocol._buffer
+	if protocol.decoder is not None:
+		received=protocol.decoder.remaining() + received
+	unsent=[bytes(transport.dataBuffer[transport.offset:])] + list(transport._tempDataBuffer)
+	if protocol.queue.frames:
+		unsent.extend(protocol.queue.frames)
+	return {
+		'family': transport.socket.family,
+		'name': pack(protocol.name),
+		'room': pack(protocol.room.name),
+		'profile': protocol.profile,
+		'received': pack(received),
+		'unsent': pack(b''.join(unsent)),
+	}
+
+###  HandoffProtocol class, the old server's end of a takeover
+
+class HandoffProtocol(Protocol):
+
+	##  Constructor method, receives the HandoffFactory
+	def __init__(self, handoff):
+		self.handoff=handoff
+		self.users=None
+
+	##  The new process has connected. Built in Protocol method
+	def connectionMade(self):
+		'''Freezes every user and sends their sockets and descriptions across
+		'''
+		handoff=self.handoff
+		factory=handoff.chat
+		port=handoff.port
+		users=list(factory.users.values())
+		#  Nothing runs between taking the snapshot and suspending, so nothing can be read or written in between
+		state={'listener': port.socket.family, 'users': [snapshot(protocol) for protocol in users],
+			'rooms': [[pack(room.name), [pack(message.encode(FRAMED)) for message in room.history]]
+				for room in factory.rooms.values()]}
+		self.users=users
+		handoff.suspend()
+		#  Each descriptor rides along with one byte of whatever is written next
+		self.transport.sendFileDescriptor(port.fileno())
+		for protocol in self.users:
+			self.transport.sendFileDescriptor(protocol.transport.fileno())
+		data=json.dumps(state).encode('utf-8')
+		self.transport.write(struct.pack('!I', len(data)) + data)
+		print('Handing %d users over to the new process' % len(self.users))
+
+	##  Handles the acknowledgement. Built in Protocol method
+	def dataReceived(self, data):
+		'''The new process holds everything now, finish writing the log and go
+		'''
+		if data.startswith(ACK) and self.users is not None:
+			self.users=None
+			self.handoff.finish()
+
+	##  The new process has gone. Built in Protocol method
+	def connectionLost(self, reason):
+		'''Without an acknowledgement the takeover failed, so carry on serving
+		'''
+		if self.users is not None:
+			print('Takeover failed (%s), carrying on' % reason.getErrorMessage())
+			self.handoff.resume()
+			self.users=None
+
+###  HandoffFactory class (inherits from Factory), listens for a new process taking over this one
+
+class HandoffFactory(Factory):
+
+	##  Constructor method, receives the ChatFactory, its listening port and the LoopingCall turning its timer wheel
+	def __init__(self, chat, port, ticker):
+		self.chat=chat
+		self.port=port
+		self.ticker=ticker
+		#  Each suspended connection with whether its queue was already paused by the transport
+		self.suspended=[]
+
+	##  Returns a HandoffProtocol for the new process. Built in Factory method
+	def buildProtocol(self, addr):
+		return HandoffProtocol(self)
+
+	##  Function to stop serving while the users are handed over
+	def suspend(self):
+		'''Stops accepting, and reading and writing on every connection including those still registering, and stops
+		the timers so no deadline acts on a socket mid handoff. Frames sent meanwhile, say the OK for a name claim that
+		answers mid handoff, are held in the paused queues for resume
+		'''
+		self.port.stopReading()
+		if self.ticker.running:
+			self.ticker.stop()
+		self.chat.suspended=True
+		self.suspended=[(protocol, protocol.queue.paused) for protocol in self.chat.connections]
+		for protocol, paused in self.suspended:
+			protocol.transport.stopReading()
+			protocol.transport.stopWriting()
+			protocol.queue.paused=True
+
+	##  Function to serve again after a failed takeover
+	def resume(self):
+		'''Undoes suspend, nothing that was handed out has been consumed so every user carries on where they were.
+		A connection still paused, waiting on a password check or a name claim, is left for that to resume
+		'''
+		self.chat.suspended=False
+		suspended, self.suspended = self.suspended, []
+		for protocol, paused in suspended:
+			if protocol.state == GONE:
+				continue
+			protocol.transport.startWriting()
+			#  A queue the transport had paused is resumed by the transport once its buffer drains
+			if not paused:
+				protocol.queue.resumeProducing()
+			if not protocol.paused:
+				protocol.resumeProducing()
+		self.ticker.start(self.ticker.interval, now=False)
+		self.port.startReading()
+
+	##  Function to leave once the new process has taken over
+	def finish(self):
+		'''Closes the log and exits straight away, without the orderly shutdown of the sockets the new process now owns
+		'''
+		if self.chat.log is not None:
+			self.chat.log.close()
+		print('Handed over, exiting')
+		os._exit(0)
+
+##  Function to listen for a future takeover
+def listenHandoff(reactor, path, chat, port, ticker):
+	'''Replaces any socket file left at the path, only the owner of the process may connect
+	'''
+	if os.path.exists(path):
+		os.unlink(path)
+	return reactor.listenUNIX(path, HandoffFactory(chat, port, ticker), mode=0o600)
+
+##  Function to take over from a running server
+def takeOver(path):
+	'''Connects to the old process and reads the sockets and state it hands over, then waits for it to exit so the log,
+	the metrics port and the handoff path are free. Returns the state and the file descriptors
+	'''
+	sock=socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	sock.connect(path)
+	data=b''
+	fds=[]
+	size=None
+	while size is None or len(data) < size + 4:
+		received, ancillary, flags, address = sock.recvmsg(65536, socket.CMSG_SPACE(MAX_FDS_PER_READ * 4))
+		if not received:
+			raise SystemExit('The old server closed the handoff socket before handing over')
+		data+=received
+		for level, kind, payload in ancillary:
+			if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+				fds.extend(struct.unpack('%di' % (len(payload) // 4), payload[:len(payload) - len(payload) % 4]))
+		if size is None and len(data) >= 4:
+			size=struct.unpack('!I', data[:4])[0]
+	state=json.loads(data[4:size + 4].decode('utf-8'))
+	sock.sendall(ACK)
+	while sock.recv(4096):
+		pass
+	sock.close()
+	return state, fds
+
+###  AdoptedFactory class (inherits from Factory), hands the reactor a ChatProtocol that has already been set up
+
+class AdoptedFactory(Factory):
+
+	def __init__(self, protocol):
+		self.protocol=protocol
+
+	def buildProtocol(self, addr):
+		return self.protocol
+
+##  Function to put the handed over users back
+def restore(reactor, chat, state, fds):
+	'''Adopts the listening socket and every user's socket, puts each user back in their room and picks up where the
+	old process left off on their input and output. Returns the listening port
+	'''
+	port=reactor.adoptStreamPort(fds[0], state['listener'], chat)
+	os.close(fds[0])
+	restored=[]
+	for user, fd in zip(state['users'], fds[1:]):
+		protocol=chat.buildProtocol(None)
+		protocol.name=chat.internName(unpack(user['name']))
+		protocol.state=CHATTING
+		protocol.profile=user['profile']
+		if protocol.profile != LINE:
+			protocol.decoder=chat_frames.FrameDecoder(max_length=MAX_CLIENT_FRAME, inflate=False)
+			protocol.line_mode=0
+		reactor.adoptStreamConnection(fd, user['family'], AdoptedFactory(protocol))
+		os.close(fd)
+		chat.users[protocol.name]=protocol
+		chat.joinRoom(protocol, unpack(user['room']))
+		unsent=unpack(user['unsent'])
+		if unsent:
+			protocol.sendFrame(unsent)
+		restored.append((protocol, unpack(user['received'])))
+	for name, frames in state['rooms']:
+		room=chat.rooms.get(unpack(name))
+		if room is not None:
+			for frame in frames:
+				room.remember(Message.fromFrame(unpack(frame)))
+	#  Only once everyone is back, the input may be a message for the whole room
+	for protocol, received in restored:
+		if received:
+			protocol.dataReceived(received)
+	print('***** Took over %d users *****' % len(restored))
+	return port
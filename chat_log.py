@@ -0,0 +1,346 @@
+#!/usr/bin/python
+
+#  Append-only, segmented on-disk log of chat messages. The reactor thread only ever hands records to a queue, a
+#  single writer thread batches them into large writes and fsyncs on a timer, so the reactor never waits on the disk.
+#  Reads go straight to memory-mapped segments through a sparse in-memory index of record positions.
+#
+#  Each record is laid out as
+#
+#      4 byte payload length | 8 byte offset | 8 byte timestamp | 1 byte room length | room | message frame
+#
+#  where the offset numbers every record in the log, starting at 0 and never reused.
+
+import bisect
+import mmap
+import os
+import struct
+import threading
+import time
+
+try:
+	import queue
+except ImportError:
+	import Queue as queue
+
+_header = struct.Struct('!IQd')
+
+#  Defaults for segment size, how often records are indexed and the fsync and retention policies
+SEGMENT_BYTES = 16 * 1024 * 1024
+INDEX_INTERVAL = 64
+FSYNC_INTERVAL = 1.0
+RETENTION_BYTES = 256 * 1024 * 1024
+RETENTION_SECONDS = 7 * 24 * 3600
+
+#  Most records a single read will return, and most records of the whole log searched for one room's last records
+MAX_READ = 500
+LAST_SCAN = 50000
+
+#  Number of in-memory pending records that triggers dropping the ones already written
+PENDING_TRIM = 1024
+
+###  Segment class, one file of the log holding a run of consecutive offsets
+
+class Segment(object):
+
+	##  Constructor method, receives the segment's path and the offset of its first record
+	def __init__(self, path, base):
+		'''Creates the segment's bookkeeping, the file itself is written by the writer thread
+		'''
+		self.path=path
+		self.base=base
+		#  Sparse index, the offsets and file positions of every INDEX_INTERVAL-th record
+		self.index_offsets=[]
+		self.index_positions=[]
+		#  Size the segment will have once everything handed to the writer is on disk
+		self.size=0
+		#  Size already written, updated by the writer thread
+		self.written=0
+		self.newest=0.0
+		self.map=None
+		self.mapped=0
+
+	##  Function to find where to start scanning for an offset
+	def seek(self, offset):
+		'''Returns the offset and position of the last indexed record at or before the offset
+		'''
+		i=bisect.bisect_right(self.index_offsets, offset) - 1
+		if i < 0:
+			return self.base, 0
+		return self.index_offsets[i], self.index_positions[i]
+
+	##  Function to get a read only map of the written part of the segment
+	def view(self):
+		'''Maps the segment, mapping it again only if more of it has been written since last time
+		'''
+		written=self.written
+		if self.map is None or self.mapped < written:
+			self.close()
+			with open(self.path, 'rb') as segment:
+				self.map=mmap.mmap(segment.fileno(), written, access=mmap.ACCESS_READ)
+			self.mapped=written
+		return self.map
+
+	##  Function to drop the segment's map
+	def close(self):
+		'''Unmaps the segment if it is mapped
+		'''
+		if self.map is not None:
+			self.map.close()
+			self.map=None
+			self.mapped=0
+
+###  MessageLog class, the log as a whole
+
+class MessageLog(object):
+
+	##  Constructor method, receives the directory holding the segments and the log's policies
+	def __init__(self, directory, segment_bytes=SEGMENT_BYTES, index_interval=INDEX_INTERVAL, fsync_interval=FSYNC_INTERVAL,
+			retention_bytes=RETENTION_BYTES, retention_seconds=RETENTION_SECONDS):
+		'''Opens the log, recovering the index from any segments already in the directory, and starts the writer thread
+		'''
+		self.directory=directory
+		self.segment_bytes=segment_bytes
+		self.index_interval=index_interval
+		self.fsync_interval=fsync_interval
+		self.retention_bytes=retention_bytes
+		self.retention_seconds=retention_seconds
+		self.segments=[]
+		self.next_offset=0
+		#  Records handed to the writer but maybe not on disk yet, served to readers from memory
+		self.pending=[]
+		self.pending_offsets=[]
+		self.written_offset=0
+		self.queue=queue.Queue()
+		if not os.path.isdir(directory):
+			os.makedirs(directory)
+		self.recover()
+		self.written_offset=self.next_offset
+		self.applyRetention()
+		self.writer=threading.Thread(target=self.writeLoop, name='chat-log-writer')
+		self.writer.daemon=True
+		self.writer.start()
+
+	##  Function to rebuild the segments and index from the files on disk
+	def recover(self):
+		'''Walks the record headers of every segment, cutting off a record left half written by a crash
+		'''
+		names=sorted(name for name in os.listdir(self.directory) if name.endswith('.log'))
+		for name in names:
+			segment=Segment(os.path.join(self.directory, name), int(name[:-4]))
+			with open(segment.path, 'rb') as data:
+				contents=data.read()
+			position=0
+			while position + _header.size <= len(contents):
+				length, offset, stamp = _header.unpack_from(contents, position)
+				end=position + _header.size + length
+				if end > len(contents):
+					break
+				if (offset - segment.base) % self.index_interval == 0:
+					segment.index_offsets.append(offset)
+					segment.index_positions.append(position)
+				segment.newest=stamp
+				self.next_offset=offset + 1
+				position=end
+			if position < len(contents):
+				with open(segment.path, 'r+b') as data:
+					data.truncate(position)
+			segment.size=segment.written=position
+			self.segments.append(segment)
+
+	##  Function to add a message to the log
+	def append(self, room, frame):
+		'''Assigns the message the next offset and hands it to the writer, returns the offset
+		'''
+		offset=self.next_offset
+		now=time.time()
+		payload=struct.pack('!B', len(room)) + room + frame
+		record=_header.pack(len(payload), offset, now) + payload
+		segment=self.activeSegment(offset, len(record))
+		self.next_offset=offset + 1
+		if (offset - segment.base) % self.index_interval == 0:
+			segment.index_offsets.append(offset)
+			segment.index_positions.append(segment.size)
+		segment.size+=len(record)
+		segment.newest=now
+		self.pending.append((offset, now, room, frame))
+		self.pending_offsets.append(offset)
+		#  Nobody may be reading, so trim here too, in batches to keep appends cheap
+		if len(self.pending) >= PENDING_TRIM:
+			self.trimPending()
+		self.queue.put(('write', segment, record, offset))
+		return offset
+
+	##  Function to get the segment the next record goes into
+	def activeSegment(self, offset, size):
+		'''Returns the newest segment, rolling over to a new one when the record would take it past the size limit
+		'''
+		if self.segments:
+			segment=self.segments[-1]
+			if segment.size == 0 or segment.size + size <= self.segment_bytes:
+				return segment
+		#  Segments are named after the offset of their first record
+		segment=Segment(os.path.join(self.directory, '%020d.log' % offset), offset)
+		self.segments.append(segment)
+		self.applyRetention()
+		return segment
+
+	##  Function to drop old segments
+	def applyRetention(self):
+		'''Deletes the oldest segments, never the active one, while the log is over its size or age limit
+		'''
+		cutoff=time.time() - self.retention_seconds
+		while len(self.segments) > 1:
+			oldest=self.segments[0]
+			total=sum(segment.size for segment in self.segments)
+			if total <= self.retention_bytes and oldest.newest >= cutoff:
+				break
+			self.segments.pop(0)
+			oldest.close()
+			self.queue.put(('delete', oldest))
+
+	##  Function to read records starting from an offset
+	def read(self, start, limit=MAX_READ):
+		'''Returns up to limit (offset, timestamp, room, frame) records from start onwards
+		'''
+		limit=min(limit, MAX_READ)
+		self.trimPending()
+		records=[]
+		written=self.written_offset
+		if start < written and self.segments:
+			i=max(bisect.bisect_right([segment.base for segment in self.segments], start) - 1, 0)
+			for segment in self.segments[i:]:
+				self.readSegment(segment, max(start, segment.base), written, limit, records)
+				if len(records) >= limit:
+					return records
+		#  Anything the writer has not finished with yet comes from memory
+		i=bisect.bisect_left(self.pending_offsets, max(start, written))
+		records.extend(self.pending[i:i + limit - len(records)])
+		return records
+
+	##  Function to read the last records in the log
+	def last(self, count, room=None):
+		'''Returns the most recent count records, oldest first. Given a room, returns that room's most recent records,
+		reading back MAX_READ records at a time through at most LAST_SCAN records of the whole log
+		'''
+		count=min(count, MAX_READ)
+		if room is None:
+			return self.read(max(self.next_offset - count, 0), count)
+		if count <= 0:
+			return []
+		records=[]
+		end=self.next_offset
+		oldest=max(self.segments[0].base if self.segments else 0, end - LAST_SCAN)
+		while end > oldest and len(records) < count:
+			start=max(end - MAX_READ, oldest)
+			records[:0]=[record for record in self.read(start, end - start) if record[0] < end and record[2] == room]
+			end=start
+		return records[-count:]
+
+	##  Function to read records out of one segment's map
+	def readSegment(self, segment, start, written, limit, records):
+		'''Scans forward from the nearest indexed record, decoding only the records asked for
+		'''
+		if segment.written == 0:
+			return
+		view=segment.view()
+		offset, position = segment.seek(start)
+		end=segment.mapped
+		while position + _header.size <= end and len(records) < limit:
+			length, offset, stamp = _header.unpack_from(view, position)
+			body=position + _header.size
+			if offset >= written:
+				return
+			if offset >= start:
+				size=struct.unpack('!B', view[body:body + 1])[0]
+				records.append((offset, stamp, view[body + 1:body + 1 + size], view[body + 1 + size:body + length]))
+			position=body + length
+
+	##  Function to forget pending records the writer has finished with
+	def trimPending(self):
+		'''Drops records below the written offset from the in-memory list
+		'''
+		i=bisect.bisect_left(self.pending_offsets, self.written_offset)
+		if i:
+			del self.pending[:i]
+			del self.pending_offsets[:i]
+
+	##  Function to stop the writer
+	def close(self):
+		'''Waits for the writer to put everything queued so far on disk, then unmaps the segments
+		'''
+		self.queue.put(('stop',))
+		self.writer.join(10)
+		for segment in self.segments:
+			segment.close()
+
+	##  The writer thread's loop
+	def writeLoop(self):
+		'''Drains the queue in batches, one write per segment per batch, and fsyncs at most once per interval
+		'''
+		files={}
+		last_sync=time.time()
+		dirty=set()
+		running=True
+		while running:
+			try:
+				ops=[self.queue.get(timeout=self.fsync_interval)]
+			except queue.Empty:
+				ops=[]
+			while True:
+				try:
+					ops.append(self.queue.get_nowait())
+				except queue.Empty:
+					break
+			chunks=[]
+			for op in ops:
+				if op[0] == 'write':
+					if chunks and chunks[-1][0] is not op[1]:
+						self.writeChunk(files, dirty, chunks)
+					chunks.append(op[1:])
+				else:
+					self.writeChunk(files, dirty, chunks)
+					if op[0] == 'delete':
+						handle=files.pop(op[1].path, None)
+						if handle is not None:
+							handle.close()
+						dirty.discard(op[1].path)
+						try:
+							os.remove(op[1].path)
+						except OSError:
+							pass
+					else:
+						running=False
+			self.writeChunk(files, dirty, chunks)
+			if dirty and (not running or time.time() - last_sync >= self.fsync_interval):
+				for path in dirty:
+					handle=files.get(path)
+					if handle is not None:
+						os.fsync(handle.fileno())
+				dirty.clear()
+				last_sync=time.time()
+		for handle in files.values():
+			handle.close()
+
+	##  Function to write a run of records bound for the same segment
+	def writeChunk(self, files, dirty, chunks):
+		'''Writes the records in one call and publishes how far the log has been written
+		'''
+		if not chunks:
+			return
+		segment=chunks[0][0]
+		handle=files.get(segment.path)
+		if handle is None:
+			#  A new segment means the previous one is finished with
+			for path in list(files):
+				if path in dirty:
+					os.fsync(files[path].fileno())
+					dirty.discard(path)
+				files.pop(path).close()
+			handle=files[segment.path]=open(segment.path, 'ab')
+		data=b''.join([chunk[1] for chunk in chunks])
+		handle.write(data)
+		handle.flush()
+		dirty.add(segment.path)
+		segment.written+=len(data)
+		self.written_offset=chunks[-1][2] + 1
+		del chunks[:]
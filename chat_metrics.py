@@ -0,0 +1,184 @@
+#!/usr/bin/python
+
+#  Small metrics registry for the chat server. Counters and histograms are plain attribute updates so the hot paths
+#  can afford them, gauges that would need bookkeeping on every change are worked out when they are scraped instead.
+#  The registry renders itself in the Prometheus text exposition format and is served over HTTP on its own port.
+
+import bisect
+from timeit import default_timer as timer
+
+from twisted.web.resource import Resource
+from twisted.web.server import Site
+
+#  Bucket bounds for the fan out size and broadcast time histograms
+FANOUT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+LATENCY_BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0)
+
+##  Function to format a sample value
+def formatValue(value):
+	'''Returns whole numbers without a decimal point and anything else as Python writes it
+	'''
+	if isinstance(value, float) and not value.is_integer():
+		return repr(value)
+	return '%d' % value
+
+###  Counter class, a value that only goes up
+
+class Counter(object):
+
+	__slots__ = ('name', 'help', 'value')
+
+	##  Constructor method, receives the metric's name and help text
+	def __init__(self, name, help):
+		self.name=name
+		self.help=help
+		self.value=0
+
+	##  Function to add to the counter
+	def inc(self, amount=1):
+		self.value+=amount
+
+	##  Function to write the metric out
+	def render(self):
+		'''Returns the exposition lines for the counter
+		'''
+		return ['# HELP %s %s' % (self.name, self.help), '# TYPE %s counter' % self.name,
+			'%s %s' % (self.name, formatValue(self.value))]
+
+###  Gauge class, a value that goes up and down, or one read from a function at scrape time
+
+class Gauge(object):
+
+	__slots__ = ('name', 'help', 'value', 'function')
+
+	##  Constructor method, receives the metric's name and help text and optionally the function giving its value
+	def __init__(self, name, help, function=None):
+		self.name=name
+		self.help=help
+		self.value=0
+		self.function=function
+
+	##  Functions to move the gauge
+	def inc(self, amount=1):
+		self.value+=amount
+
+	def dec(self, amount=1):
+		self.value-=amount
+
+	##  Function to write the metric out
+	def render(self):
+		'''Returns the exposition lines for the gauge, calling its function if it has one
+		'''
+		value=self.function() if self.function is not None else self.value
+		return ['# HELP %s %s' % (self.name, self.help), '# TYPE %s gauge' % self.name,
+			'%s %s' % (self.name, formatValue(value))]
+
+###  Histogram class, counts observations into fixed buckets
+
+class Histogram(object):
+
+	__slots__ = ('name', 'help', 'bounds', 'counts', 'sum', 'count')
+
+	##  Constructor method, receives the metric's name, help text and the upper bounds of its buckets
+	def __init__(self, name, help, bounds):
+		self.name=name
+		self.help=help
+		self.bounds=tuple(bounds)
+		#  One count per bucket plus the last one for everything above the highest bound
+		self.counts=[0] * (len(self.bounds) + 1)
+		self.sum=0
+		self.count=0
+
+	##  Function to record an observation
+	def observe(self, value):
+		'''Adds the value to the first bucket whose bound it does not exceed
+		'''
+		self.counts[bisect.bisect_left(self.bounds, value)]+=1
+		self.sum+=value
+		self.count+=1
+
+	##  Function to write the metric out
+	def render(self):
+		'''Returns the exposition lines for the histogram, with the buckets made cumulative
+		'''
+		lines=['# HELP %s %s' % (self.name, self.help), '# TYPE %s histogram' % self.name]
+		total=0
+		for bound, count in zip(self.bounds + ('+Inf',), self.counts):
+			total+=count
+			le=bound if bound == '+Inf' else formatValue(bound)
+			lines.append('%s_bucket{le="%s"} %d' % (self.name, le, total))
+		lines.append('%s_sum %s' % (self.name, formatValue(self.sum)))
+		lines.append('%s_count %d' % (self.name, self.count))
+		return lines
+
+###  Registry class, every metric the server keeps
+
+class Registry(object):
+
+	##  Constructor method, creates an empty registry
+	def __init__(self):
+		self.metrics=[]
+
+	##  Function to add a metric to the registry
+	def add(self, metric):
+		'''Registers the metric and returns it, so metrics can be made and kept in one line
+		'''
+		self.metrics.append(metric)
+		return metric
+
+	##  Function to write out every metric
+	def render(self):
+		'''Returns the whole registry in the text exposition format as bytes
+		'''
+		lines=[]
+		for metric in self.metrics:
+			lines.extend(metric.render())
+		return ('\n'.join(lines) + '\n').encode('utf-8')
+
+###  ChatMetrics class (inherits from Registry), the metrics of one chat server process
+
+class ChatMetrics(Registry):
+
+	##  Constructor method, receives the ChatFactory whose state some of the gauges read when scraped
+	def __init__(self, factory):
+		'''Creates the server's metrics
+		'''
+		super(ChatMetrics, self).__init__()
+		self.connections=self.add(Gauge('chat_connections', 'Open client connections'))
+		self.connections_total=self.add(Counter('chat_connections_total', 'Client connections accepted'))
+		self.registrations=self.add(Counter('chat_registrations_total', 'Users registered'))
+		self.login_failures=self.add(Counter('chat_login_failures_total', 'Registrations refused for a wrong name or password'))
+		self.add(Gauge('chat_users', 'Users registered on this process', lambda: len(factory.users)))
+		self.add(Gauge('chat_rooms', 'Rooms in use on this process', lambda: len(factory.rooms)))
+		self.messages_in=self.add(Counter('chat_messages_in_total', 'Chat messages received from clients'))
+		self.messages_out=self.add(Counter('chat_messages_out_total', 'Messages delivered to clients by broadcasts'))
+		self.direct=self.add(Counter('chat_direct_messages_total', 'Private messages and mentions delivered to one user'))
+		self.rate_limited=self.add(Counter('chat_rate_limited_total', 'Lines dropped by a rate limit'))
+		self.add(Gauge('chat_queued_bytes', 'Bytes held back in the outbound queues of slow clients',
+			lambda: sum(protocol.queue.queued_bytes for protocol in factory.users.values())))
+		self.fanout=self.add(Histogram('chat_fanout_size', 'Recipients of each broadcast', FANOUT_BUCKETS))
+		self.broadcast_seconds=self.add(Histogram('chat_broadcast_seconds', 'Time taken to fan each broadcast out', LATENCY_BUCKETS))
+
+###  MetricsResource class (inherits from Resource), serves a registry over HTTP
+
+class MetricsResource(Resource):
+
+	isLeaf = True
+
+	##  Constructor method, receives the registry to serve
+	def __init__(self, registry):
+		Resource.__init__(self)
+		self.registry=registry
+
+	##  Handles a GET for any path. Built in Resource method
+	def render_GET(self, request):
+		'''Returns the registry in the text exposition format
+		'''
+		request.setHeader(b'Content-Type', b'text/plain; version=0.0.4; charset=utf-8')
+		return self.registry.render()
+
+##  Function to serve a registry on a local port
+def listenMetrics(reactor, registry, port, interface='127.0.0.1'):
+	'''Starts the HTTP endpoint and returns the listening port
+	'''
+	return reactor.listenTCP(port, Site(MetricsResource(registry)), interface=interface)
@@ -1,125 +1,258 @@
 #!/usr/bin/python
 
 #  Import the twisted methods of Factory, LineReceiver and the Reactor
+import argparse
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import time
 from twisted.internet import reactor
-from twisted.internet.protocol import Factory
-from twisted.protocols.basic import LineReceiver
+from twisted.internet.error import ProcessExitedAlready
+from twisted.internet.protocol import ProcessProtocol
+from twisted.internet.task import LoopingCall
+import chat_handoff
+from chat_bus import BusHub, BusClientFactory
+from chat_core import (ChatFactory, MAX_QUEUE_BYTES, MAX_QUEUE_MESSAGES, HISTORY_MESSAGES, HISTORY_BYTES, LINE_RATE, LINE_BURST,
+	ADDRESS_RATE, ADDRESS_BURST, OUTPUT_RATE, OUTPUT_BURST, REGISTRATION_TIMEOUT, PING_INTERVAL, IDLE_TIMEOUT, TIMER_TICK,
+	DROP_OLDEST, OVERFLOW_POLICIES)
+from chat_log import MessageLog, SEGMENT_BYTES, RETENTION_BYTES, RETENTION_SECONDS
+from chat_auth import (Authenticator, CredentialStore, AUTH_THREADS, CACHE_SIZE, CACHE_SECONDS, MAX_PENDING, LOGIN_RATE,
+	LOGIN_BURST)
+from chat_metrics import listenMetrics
 
-###  Define the main Class and pass the Line receiver as a parameter
+#  A worker that exits within WORKER_MIN_LIFE seconds of starting is restarted after a delay, doubling from
+#  RESPAWN_DELAY up to RESPAWN_MAX_DELAY while it keeps failing, so a worker that cannot start does not spin
+WORKER_MIN_LIFE = 10.0
+RESPAWN_DELAY = 1.0
+RESPAWN_MAX_DELAY = 30.0
 
-class ChatProtocol(LineReceiver):
-		
-	##  Initialise the Constructor passing the ChatFactory object as an argument
-	def __init__(self, factory):
-		'''Constructs the instance variables as well as the starting state of new users
-		'''
-		#  Initialise the instance variables, set our name to None and set our state to New User
-		#print('Init')
-		self.factory=factory
-		self.name=None
-		self.state='New User'
-		
-	##  Reactor receives an incoming connection. Built in Line Receiver method.
-	def connectionMade(self):
-		'''Function to react to a new connection; sets the initial user state to NewUser
-		'''
-		#  Check the 'state' of the user, if this is a new user send a welcome message otherwise the user is already registered as active, pass	
-		if self.state == 'New User':
-			self.sendLine('>>>    An Seo!    <<<') 
+###  WorkerProcess class (inherits from ProcessProtocol), watches one worker process on behalf of the master
+
+class WorkerProcess(ProcessProtocol):
 	
-	#  If the connection breaks down, handle notification and update the user dictionary. Built in Line Receiver method.
-	#  Note, 'reason' is an exception variable returned by the protocol
-	def connectionLost(self, reason):
-		'''This function takes care of any break in connection between server and client
-		'''
-		#  If the user exists in the user dictionary remove the value associated with them
-		if self.name in self.factory.users:
-			del self.factory.users[self.name]
-			#  Notify all other users of the users departure from the chat, call the broadcastMessage function
-			self.broadcastMessage(' >>>   User %s amach sa teach !  <<<'%self.name)
-			
-	## Function handles the different possible incoming connections, either the user is active and currently chatting so they can be passed to handleChat function
-	## or this is a new user in which case they need to be passed to the handle_Register function for processing. Built in Line Receiver method.
-	def lineReceived(self, line):
-		'''Responsible for controlling the flow of operation, identifies if a client is currently active or if they have just joined
-		the chat and then passes them to their relevant handler functions
-		'''
-		#print('Received')
-		#If this instance is a new user pass the line to the handle_Register function, otherwise pass the line to the handle_Chat function.
-		if self.state=='New User':
-			#print('Registering')
-			self.handle_Register(line)
-		else:
-			#print('Chatting')
-			self.handle_Chat(line)
-		
-	##  Function to register new users
-	def handle_Register(self, name):
-		'''This function is responsible registering new users
+	##  Constructor method, receives the command line used to start the worker
+	def __init__(self, args):
+		self.args=args
+		self.started=0.0
+		self.delay=0.0
+	
+	##  Function to run the worker, and run it again each time it is replaced
+	def spawn(self):
+		'''Runs this script again as a worker, sharing the master's stdout and stderr
 		'''
-		#print('Handle reg')
-		#  If the name already exists in the user dictionary, ask again. 
-		if name in self.factory.users:
-			self.sendLine('>>> Username taken! <<<')
+		if stopping:
 			return
-		else:
-			self.sendLine('OK<')
-		#  Otherwise notify other clients of the new client	
-		self.broadcastMessage('>>>   User %s AnSeo !   <<<'%name)
-		#  Assign the instance variable to the user name received
-		self.name=name
-		#  Set the current name in the dictionary to represent this instance and set the state to one of a registered user
-		self.factory.users[name]=self
-		self.state ='CHAT'
+		self.started=time.time()
+		self.transport=reactor.spawnProcess(self, self.args[0], self.args, env=os.environ, childFDs={0: 0, 1: 1, 2: 2})
 	
-	##  Function to handle the incoming messages	
-	def handle_Chat(self, message):
-		'''This function reacts to and also handles the received messages from the client
+	##  The worker has exited. Built in ProcessProtocol method
+	def processEnded(self, reason):
+		'''Starts a replacement worker unless the master itself is shutting down, waiting first if this one did not
+		last long
 		'''
-		print('Handle chat')
-		#  Format the message and store it, once done pass the message to the broadcastMessage function
-		message = '>>>%s : %s  <<<'%(self.name, message)
-		self.broadcastMessage(message)
-	
-	##  Function to handle the broadcasting of messages between clients
-	def broadcastMessage(self, message):
-		print('Broadcast')
-		print(str(self.factory.users))
-		#  For each name and protocol item in the user dictionary 
-		for name, protocol in self.factory.users.iteritems():
-			#  Check to see if it is this instance, if not then pass the message to the client
-			if protocol != self:
-				protocol.sendLine(message)
+		if reactor.running and not stopping:
+			if time.time() - self.started < WORKER_MIN_LIFE:
+				self.delay=min(max(self.delay * 2, RESPAWN_DELAY), RESPAWN_MAX_DELAY)
+			else:
+				self.delay=0.0
+			print('Worker exited (%s), starting a new one in %d seconds' % (reason.getErrorMessage(), self.delay))
+			reactor.callLater(self.delay, self.spawn)
 
+#  Set once the master starts shutting down, so exiting workers are not replaced
+stopping=False
 
-###  ChatFactory class (inherits from Factory), used to create, store and manage the multiple connections to the server		
+##  Function to start one worker process
+def spawnWorker(args):
+	'''Returns the WorkerProcess watching the new worker, which stays the same across replacements
+	'''
+	process=WorkerProcess(args)
+	process.spawn()
+	return process
 
-class ChatFactory(Factory):
+##  Function to run the master process for --workers mode
+def runMaster(options, argv):
+	'''Starts the worker bus and N workers, each of which accepts on the shared port
+	'''
+	path=os.path.join(tempfile.mkdtemp(prefix='anseo-'), 'bus.sock')
+	reactor.listenUNIX(path, BusHub())
+	args=[sys.executable, os.path.abspath(__file__)] + list(argv) + ['--bus', path]
+	workers=[spawnWorker(args + ['--worker-index', str(i)]) for i in range(options.workers)]
 	
-	##  Constructor method, creates the user dictionary and then builds a TCP object factory, location of shared state variables.
-	def __init__(self):
-		self.users={}
-		print('***** Welcome to the "An Seo" Server *****')
-		print('*****    Server is listening....     *****')
-	
-	##  Returns a ChatProtocol object for each instance. Built in Factory method
-	def buildProtocol(self, addr):
-		'''This function returns an instance of ChatProtocol for each client received
-		'''
-		return ChatProtocol(self)
-
-#  Create a Factory Instance  
-cf = ChatFactory()
-#  Tell the reactor to listen for incoming TCP streams on the default port, applying the rules set out in the Chat Protocol when it receives something,
-#   via Chat Factory object
-reactor.listenTCP(60001, cf)
-#  Initiate the reactor
-reactor.run()
-
-		
-		
-		
-		
-		
-		
-		
+	#  Take the workers down with us
+	def shutdown():
+		global stopping
+		stopping=True
+		for worker in workers:
+			try:
+				worker.transport.signalProcess('TERM')
+			except ProcessExitedAlready:
+				pass
+	reactor.addSystemEventTrigger('before', 'shutdown', shutdown)
+	#  The bus socket is only gone once the reactor has closed its port
+	reactor.addSystemEventTrigger('after', 'shutdown', shutil.rmtree, os.path.dirname(path), True)
+	print('***** Started %d workers on port %d *****' % (options.workers, options.port))
+
+##  Function to listen on a port that other worker processes are listening on too
+def listenReusePort(port, factory):
+	'''Binds with SO_REUSEPORT so the kernel spreads incoming connections across every worker
+	'''
+	skt=socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+	skt.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+	skt.setsockopt(socket.SOL_SOCKET, getattr(socket, 'SO_REUSEPORT', 15), 1)
+	skt.bind(('', port))
+	skt.listen(50)
+	skt.setblocking(False)
+	listening=reactor.adoptStreamPort(skt.fileno(), socket.AF_INET, factory)
+	#  The reactor holds its own copy of the socket now
+	skt.close()
+	return listening
+
+##  Function to give up on a worker that could not listen
+def listenFailed(failure, port):
+	'''Reports why and stops the worker, which the master restarts after a delay
+	'''
+	global listen_failed
+	listen_failed=True
+	print('Could not listen on port %d: %s' % (port, failure.getErrorMessage()))
+	reactor.stop()
+
+#  Set when a worker gives up on listening, so it exits with an error
+listen_failed=False
+
+##  Function to parse the command line
+def parseArgs(argv):
+	'''Returns the server options
+	'''
+	parser=argparse.ArgumentParser(description='An Seo chat server')
+	parser.add_argument('--port', type=int, default=60001, help='TCP port to listen on')
+	parser.add_argument('--engine', choices=('twisted', 'asyncio'), default='twisted', help='event loop to run the server on')
+	parser.add_argument('--no-uvloop', dest='uvloop', action='store_false', help='run the asyncio engine on the standard loop even if uvloop is installed')
+	parser.add_argument('--workers', type=int, default=1, help='number of worker processes accepting on the port')
+	parser.add_argument('--max-queue-bytes', type=int, default=MAX_QUEUE_BYTES, help='bytes held back for a client that is not reading')
+	parser.add_argument('--max-queue-messages', type=int, default=MAX_QUEUE_MESSAGES, help='messages held back for a client that is not reading')
+	parser.add_argument('--overflow-policy', choices=OVERFLOW_POLICIES, default=DROP_OLDEST, help='what to do with a client over its queue limits')
+	parser.add_argument('--history-messages', type=int, default=HISTORY_MESSAGES, help='chat messages each room replays to users joining it, 0 to turn history off')
+	parser.add_argument('--history-bytes', type=int, default=HISTORY_BYTES, help='bytes of chat history each room keeps, counting the text and every encoding kept of it')
+	parser.add_argument('--log-dir', help='directory for the append-only message log, the log is off when not given')
+	parser.add_argument('--log-segment-bytes', type=int, default=SEGMENT_BYTES, help='size at which the log rolls over to a new segment')
+	parser.add_argument('--log-retention-bytes', type=int, default=RETENTION_BYTES, help='oldest log segments are deleted beyond this total size')
+	parser.add_argument('--log-retention-seconds', type=int, default=RETENTION_SECONDS, help='log segments older than this are deleted')
+	parser.add_argument('--line-rate', type=float, default=LINE_RATE, help='lines per second each connection may send, 0 for no limit')
+	parser.add_argument('--line-burst', type=float, default=LINE_BURST, help='lines a connection may send at once before its rate applies')
+	parser.add_argument('--address-rate', type=float, default=ADDRESS_RATE, help='lines per second all connections from one address may send, 0 for no limit')
+	parser.add_argument('--address-burst', type=float, default=ADDRESS_BURST, help='lines one address may send at once before its rate applies')
+	parser.add_argument('--output-rate', type=float, default=OUTPUT_RATE, help='message deliveries per second for the whole server, 0 for no limit')
+	parser.add_argument('--output-burst', type=float, default=OUTPUT_BURST, help='message deliveries the server may make at once before its rate applies, a bigger fan out is charged this much')
+	parser.add_argument('--registration-timeout', type=float, default=REGISTRATION_TIMEOUT, help='seconds a new connection has to register, 0 for no limit')
+	parser.add_argument('--ping-interval', type=float, default=PING_INTERVAL, help='seconds of quiet before a framed client is pinged, 0 to never ping')
+	parser.add_argument('--idle-timeout', type=float, default=IDLE_TIMEOUT, help='seconds of quiet after which a framed client is dropped, 0 for no limit')
+	parser.add_argument('--metrics-port', type=int, default=0, help='serve metrics in the Prometheus text format on this port, workers use the ports after it, 0 to turn metrics off')
+	parser.add_argument('--metrics-interface', default='127.0.0.1', help='address the metrics endpoint listens on')
+	parser.add_argument('--no-deflate', dest='deflate', action='store_false', help='send plain frames to clients asking for compression')
+	parser.add_argument('--auth-db', help='SQLite credential store made with chat_auth.py, users must then give a password to register')
+	parser.add_argument('--auth-threads', type=int, default=AUTH_THREADS, help='threads hashing passwords at once')
+	parser.add_argument('--auth-cache', type=int, default=CACHE_SIZE, help='recent logins remembered so reconnecting users are not hashed again, 0 to turn the cache off')
+	parser.add_argument('--auth-cache-seconds', type=float, default=CACHE_SECONDS, help='how long a remembered login is good for, removals and password changes apply at once regardless')
+	parser.add_argument('--auth-pending', type=int, default=MAX_PENDING, help='password checks that may wait for a thread before further logins are refused')
+	parser.add_argument('--login-rate', type=float, default=LOGIN_RATE, help='password checks per second each address may ask for, 0 for no limit')
+	parser.add_argument('--login-burst', type=float, default=LOGIN_BURST, help='password checks one address may ask for at once before its rate applies')
+	parser.add_argument('--handoff-socket', help='UNIX socket a new server started with --takeover connects to in order to take this one\'s users over')
+	parser.add_argument('--takeover', action='store_true', help='take the port and every user over from the server listening on --handoff-socket')
+	parser.add_argument('--nagle', dest='nodelay', action='store_false', help='leave Nagle\'s algorithm on for client connections')
+	#  Internal, passed by the master to its workers
+	parser.add_argument('--bus', help=argparse.SUPPRESS)
+	parser.add_argument('--worker-index', type=int, default=0, help=argparse.SUPPRESS)
+	return parser.parse_args(argv)
+
+##  Function to open the message log if the command line asks for one
+def openLog(options):
+	'''Returns the MessageLog, or None when the log is turned off
+	'''
+	if options.log_dir is None:
+		return None
+	directory=options.log_dir
+	#  Each worker keeps a log of its own so that no two processes append to the same segment
+	if options.bus is not None:
+		directory=os.path.join(directory, 'worker%d' % options.worker_index)
+	return MessageLog(directory, options.log_segment_bytes, retention_bytes=options.log_retention_bytes,
+		retention_seconds=options.log_retention_seconds)
+
+##  Function to set up password checks if the command line asks for them
+def openAuth(options):
+	'''Returns the Authenticator, or None when any free name may be used
+	'''
+	if options.auth_db is None:
+		return None
+	if not os.path.exists(options.auth_db):
+		raise SystemExit('No credential store at %s, create it with chat_auth.py' % options.auth_db)
+	return Authenticator(CredentialStore(options.auth_db), options.auth_cache, options.auth_cache_seconds, options.auth_pending,
+		options.login_rate, options.login_burst)
+
+##  Function to build the ChatFactory the command line describes
+def buildFactory(options):
+	'''Returns the factory, whichever engine it is going to run on
+	'''
+	return ChatFactory(options.max_queue_bytes, options.max_queue_messages, options.overflow_policy,
+		options.history_messages, options.history_bytes, openLog(options), options.line_rate, options.line_burst,
+		options.address_rate, options.address_burst, options.output_rate, options.output_burst,
+		options.registration_timeout, options.ping_interval, options.idle_timeout, options.metrics_port > 0,
+		options.deflate, options.nodelay, openAuth(options))
+
+##  Main function, starts the server in single process, master or worker mode
+def main(argv=None):
+	'''Starts the server as described by the command line and runs the reactor
+	'''
+	if argv is None:
+		argv=sys.argv[1:]
+	options=parseArgs(argv)
+	if options.takeover and options.handoff_socket is None:
+		raise SystemExit('--takeover needs --handoff-socket')
+	if options.handoff_socket is not None and (options.engine != 'twisted' or options.workers > 1):
+		raise SystemExit('--handoff-socket needs the twisted engine in a single process')
+	if options.engine == 'asyncio':
+		if options.workers > 1:
+			raise SystemExit('--workers needs the twisted engine')
+		import chat_asyncio
+		chat_asyncio.run(options, buildFactory(options))
+		return
+	if options.bus is None and options.workers > 1:
+		runMaster(options, argv)
+	else:
+		#  Take the users over from the running server first, the log and the metrics port are only free once it has gone
+		handoff=None
+		if options.takeover:
+			handoff=chat_handoff.takeOver(options.handoff_socket)
+		#  Create a Factory Instance  
+		cf = buildFactory(options)
+		if cf.log is not None:
+			reactor.addSystemEventTrigger('before', 'shutdown', cf.log.close)
+		#  Password hashing runs on the reactor's thread pool
+		if cf.auth is not None:
+			reactor.suggestThreadPoolSize(options.auth_threads)
+		#  One timer drives every connection's timeouts
+		ticker=LoopingCall(cf.wheel.advance)
+		ticker.start(TIMER_TICK, now=False)
+		if options.metrics_port > 0:
+			listenMetrics(reactor, cf.metrics, options.metrics_port + options.worker_index, options.metrics_interface)
+		if handoff is not None:
+			port=chat_handoff.restore(reactor, cf, *handoff)
+		elif options.bus is None:
+			#  Tell the reactor to listen for incoming TCP streams on the default port, applying the rules set out in the Chat Protocol when it receives something,
+			#   via Chat Factory object
+			port=reactor.listenTCP(options.port, cf)
+		else:
+			#  Connect to the master's bus first, only start accepting users once registrations can be checked cluster wide
+			reactor.connectUNIX(options.bus, BusClientFactory(cf))
+			cf.bus_attached.addCallback(lambda bus: listenReusePort(options.port, cf))
+			cf.bus_attached.addErrback(listenFailed, options.port)
+		if options.handoff_socket is not None:
+			chat_handoff.listenHandoff(reactor, options.handoff_socket, cf, port, ticker)
+	#  Initiate the reactor
+	reactor.run()
+	if listen_failed:
+		sys.exit(1)
+
+if __name__ == '__main__':
+	main()